@@ -0,0 +1,62 @@
+import re
+from decimal import ROUND_HALF_UP, Decimal
+
+# Amounts are stored as integers in the currency's smallest unit:
+# digits after the decimal point kept for each currency (USD cents, whole UZS)
+CURRENCY_DECIMALS = {
+    'USD': 2,
+    'UZS': 0,
+}
+DEFAULT_DECIMALS = 2
+MAX_AMOUNT = Decimal('1000000000000000')
+
+# Accepted inputs: 1500, 1500.5, 1500,50, 1 000 000, 1 000 000,50, 1,000,000.50
+_AMOUNT_PATTERNS = [
+    re.compile(r'^(?P<int>[0-9]+)(?:[.,](?P<frac>[0-9]{1,2}))?$'),
+    # Space, no-break space or narrow no-break space between thousands
+    re.compile(r'^(?P<int>[0-9]{1,3}(?:[ \u00a0\u202f][0-9]{3})+)(?:[.,](?P<frac>[0-9]{1,2}))?$'),
+    re.compile(r'^(?P<int>[0-9]{1,3}(?:,[0-9]{3})+)(?:\.(?P<frac>[0-9]{1,2}))?$'),
+]
+
+
+def parse_amount(text):
+    # Returns a positive Decimal, raises ValueError for anything else
+    text = text.strip()
+    for pattern in _AMOUNT_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            break
+    else:
+        raise ValueError(f'invalid amount: {text!r}')
+    integer = re.sub(r'[^0-9]', '', match.group('int'))
+    amount = Decimal(f"{integer}.{match.group('frac') or '0'}")
+    if amount <= 0 or amount >= MAX_AMOUNT:
+        raise ValueError(f'amount out of range: {text!r}')
+    return amount
+
+
+def currency_decimals(currency):
+    return CURRENCY_DECIMALS.get(currency, DEFAULT_DECIMALS)
+
+
+def to_minor_units(amount, currency):
+    # Decimal('12.34'), 'USD' -> 1234
+    scaled = Decimal(amount).scaleb(currency_decimals(currency))
+    return int(scaled.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_exact_minor_units(amount, currency):
+    # Like to_minor_units, but raises ValueError instead of rounding: more
+    # decimals than the currency has (1500.50 UZS), or nothing left (0.4 UZS)
+    scaled = Decimal(amount).scaleb(currency_decimals(currency))
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f'too many decimals for {currency}: {amount}')
+    minor = int(scaled)
+    if minor <= 0:
+        raise ValueError(f'amount out of range for {currency}: {amount}')
+    return minor
+
+
+def from_minor_units(minor, currency):
+    # 1234, 'USD' -> Decimal('12.34')
+    return Decimal(minor).scaleb(-currency_decimals(currency))
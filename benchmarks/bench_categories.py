@@ -0,0 +1,105 @@
+"""Cost of tagging a comment with its category, and of the retag job.
+
+Times categories.categorize() per comment on a mix of short Uzbek and
+Russian comments, with and without a keyword, against a naive matcher that
+tries every keyword at every word start. Then fills a temporary database
+with `rows` untagged transactions and times categories.retag() over them.
+
+Usage: python benchmarks/bench_categories.py [rows]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import categories  # noqa: E402
+import importer  # noqa: E402
+import migrations  # noqa: E402
+
+COMMENTS = [
+    'Taksi aeroportga', 'bozordan go‘sht va sabzavot', 'Nonushta kafeda', 'kommunal to‘lov',
+    'oylik maosh', 'Оплата за газ', 'Обед в кафе с коллегами', 'продукты на неделю',
+    'Зарплата за октябрь', 'kitob sotib oldim', 'dorixona', 'qarzni qaytardim',
+    'do‘stimga', 'разное', 'без комментария к этой записи', '',
+]
+CALLS = 200000
+# (keyword, category), longest first
+KEYWORD_LIST = sorted(
+    ((categories.normalize(word), category) for category, words in categories.KEYWORDS.items() for word in words),
+    key=lambda item: -len(item[0]),
+)
+
+
+def naive(comment):
+    # Every keyword against every word start
+    text = categories.normalize(comment or '')
+    starts = [i for i in range(len(text)) if not i or not categories.is_word_char(text[i - 1])]
+    for start in starts:
+        for word, category in KEYWORD_LIST:
+            if text.startswith(word, start):
+                end = start + len(word)
+                short = sum(c.isalnum() for c in word) <= categories.SHORT_KEYWORD
+                if not (short and end < len(text) and categories.is_word_char(text[end])):
+                    return category
+    return None
+
+
+def per_call(func, comments):
+    started = time.perf_counter()
+    for comment in comments:
+        func(comment)
+    return (time.perf_counter() - started) / len(comments) * 1e6
+
+
+def fill(rows):
+    random.seed(1)
+    start = datetime(2020, 1, 1)
+    batch = []
+    with storage.transaction() as conn:
+        for i in range(rows):
+            batch.append((
+                random.randrange(1000),
+                random.choice(('income', 'expense')),
+                start + timedelta(minutes=5 * i),
+                random.randint(100, 10000000),
+                'UZS',
+                random.choice(COMMENTS),
+                None,
+            ))
+            if len(batch) == 10000:
+                conn.executemany(importer.TRANSACTION_INSERT, batch)
+                batch = []
+        conn.executemany(importer.TRANSACTION_INSERT, batch)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    random.seed(0)
+    comments = [random.choice(COMMENTS) for _ in range(CALLS)]
+    for comment in COMMENTS:
+        if categories.categorize(comment) != naive(comment):
+            raise RuntimeError(f'matchers disagree on {comment!r}')
+    keywords = sum(len(words) for words in categories.KEYWORDS.values())
+    print(f"{keywords} keywords, {CALLS} calls")
+    print(f"{'matcher':<10}{'us/call':>9}")
+    print(f"{'trie':<10}{per_call(categories.categorize, comments):>9.2f}")
+    print(f"{'naive':<10}{per_call(naive, comments[:CALLS // 20]):>9.2f}")
+
+    migrations.migrate(storage.get_connection())
+    fill(rows)
+    started = time.perf_counter()
+    changed = categories.retag()
+    elapsed = time.perf_counter() - started
+    print(f"retag: {rows} rows, {changed} tagged in {elapsed:.2f} s, {rows / elapsed:.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main()
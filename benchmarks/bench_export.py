@@ -0,0 +1,123 @@
+"""Full-history export: rows/s and peak memory for growing ledgers.
+
+Fills a temporary database with one user's history of each size, then runs
+the export in a fresh process so its peak RSS is not mixed up with the fill.
+"streamed" is export.export_history into a spooled file; "fetchall" reads
+every row into a list and compresses one in-memory csv, for comparison.
+The streamed file is also read back with the importer to check the round trip.
+
+Usage: python benchmarks/bench_export.py [rows,rows,...]
+"""
+import gzip
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import categories  # noqa: E402
+import export  # noqa: E402
+import importer  # noqa: E402
+import migrations  # noqa: E402
+import storage  # noqa: E402
+
+USER_ID = 1
+COMMENTS = ['', 'oylik', 'bozor', 'taksi', 'обед', 'аренда квартиры', 'kommunal to\'lovlar']
+
+
+def fill(rows):
+    random.seed(rows)
+    start = datetime(2015, 1, 1)
+    batch = []
+    with storage.transaction() as conn:
+        for i in range(rows):
+            currency = random.choice(('USD', 'UZS'))
+            amount = random.randint(100, 500000) if currency == 'USD' else random.randint(1000, 50000000)
+            comment = random.choice(COMMENTS)
+            batch.append((
+                USER_ID,
+                random.choice(('income', 'expense')),
+                start + timedelta(minutes=5 * i),
+                amount,
+                currency,
+                comment,
+                categories.categorize(comment),
+            ))
+            if len(batch) == 10000:
+                conn.executemany(importer.TRANSACTION_INSERT, batch)
+                batch = []
+        conn.executemany(importer.TRANSACTION_INSERT, batch)
+
+
+def run_fetchall(f):
+    rows = storage.fetchall(export.EXPORT_QUERY, (USER_ID,))
+    text = io.StringIO()
+    writer = export.csv.writer(text)
+    for ts, kind, amount, currency, comment in rows:
+        writer.writerow((ts[:19], kind, export.format_amount(amount, currency), currency, comment))
+    f.write(gzip.compress(text.getvalue().encode('utf-8-sig'), export.COMPRESS_LEVEL))
+    return len(rows)
+
+
+def child(mode):
+    # Runs in its own process: exports and prints "rows seconds size rss_kb"
+    storage.get_connection()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as f:
+        started = time.perf_counter()
+        if mode == 'streamed':
+            _, rows = export.export_history(USER_ID, 'uz', f)
+        else:
+            rows = run_fetchall(f)
+        elapsed = time.perf_counter() - started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        size = f.tell()
+        if mode == 'streamed':
+            f.seek(0)
+            with gzip.GzipFile(fileobj=f, mode='rb') as archive:
+                parsed = sum(
+                    1
+                    for line, cells in importer.read_rows(archive, 'export.csv')
+                    if line > 1 and importer.parse_row(cells)
+                )
+            assert parsed == rows, (parsed, rows)
+    print(rows, elapsed, size, peak - before)
+
+
+def main():
+    sizes = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else '10000,100000,500000').split(',')]
+    db_dir = tempfile.mkdtemp()
+    print(f"{'rows':>9}{'mode':>10}{'rows/s':>11}{'MB':>7}{'peak RSS +MB':>14}")
+    for rows in sizes:
+        storage.close_all()
+        storage.DB_PATH = os.path.join(db_dir, f'export-{rows}.db')
+        migrations.migrate(storage.get_connection())
+        fill(rows)
+        storage.close_all()
+        for mode in ('streamed', 'fetchall'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--child', mode],
+                env=dict(os.environ, BENCH_DB=storage.DB_PATH),
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.split()
+            exported, elapsed, size, rss = int(output[0]), float(output[1]), int(output[2]), int(output[3])
+            print(
+                f"{exported:>9}{mode:>10}{exported / elapsed:>11.0f}"
+                f"{size / 1e6:>7.1f}{rss / 1024:>14.1f}"
+            )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        storage.DB_PATH = os.environ['BENCH_DB']
+        child(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,230 @@
+"""Load generator: simulated users going through the real conversation flows.
+
+Every user runs /start and language selection once, then rounds of income,
+expense, report and language change flows. Updates are fabricated and put on
+the dispatcher's queue, the handlers are the ones add_handlers() registers,
+and a fake bot with a configurable per-call latency stands in for Telegram.
+Each user waits for the handler (and for a report, the finished report) before
+sending the next update, like a person tapping through the menus.
+
+Prints overall updates/s and, per handler, the call count, p50/p95/p99
+latency and SQL statements per call. Reports are built in the report pool's
+worker processes, their queries are not counted.
+
+Usage: python benchmarks/bench_load.py [users] [rounds] [api_latency_ms]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ConversationHandler, Updater  # noqa: E402
+
+import bot  # noqa: E402
+import outbound  # noqa: E402
+from fakes import FakeBot, callback_update, message_update  # noqa: E402
+from report_pool import ReportPool  # noqa: E402
+from webhook import start_dispatcher, stop_dispatcher  # noqa: E402
+
+WAIT_TIMEOUT = 60
+
+
+class Recorder:
+    # Handler timings and SQL statement counts, plus per-user completion
+    # counters the simulated users wait on
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.completed = defaultdict(int)
+        self.done = threading.Condition(self.lock)
+        self.local = threading.local()
+
+    def trace(self, statement):
+        name = getattr(self.local, 'handler', None) or '(outside handlers)'
+        with self.lock:
+            self.queries[name] += 1
+
+    def timed(self, callback):
+        name = callback.__name__
+
+        def wrapper(update, context, *args, **kwargs):
+            self.local.handler = name
+            start = time.perf_counter()
+            try:
+                return callback(update, context, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.local.handler = None
+                with self.done:
+                    self.latencies[name].append(elapsed)
+                    self.completed[update.effective_user.id] += 1
+                    self.done.notify_all()
+
+        wrapper.__name__ = name
+        return wrapper
+
+    def expect(self, user_id, count):
+        with self.lock:
+            return self.completed[user_id] + count
+
+    def wait(self, user_id, target):
+        with self.done:
+            if not self.done.wait_for(lambda: self.completed[user_id] >= target, WAIT_TIMEOUT):
+                raise RuntimeError(f'user {user_id} got no answer')
+
+
+def instrument(recorder, dispatcher):
+    # Wrap the callbacks of every registered handler, including the ones
+    # nested in ConversationHandlers
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for nested in handler.entry_points + handler.fallbacks:
+                wrap(nested)
+            for state_handlers in handler.states.values():
+                for nested in state_handlers:
+                    wrap(nested)
+        else:
+            handler.callback = recorder.timed(handler.callback)
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+    # Finished reports are delivered through run_async, not a registered handler
+    bot.report_ready = recorder.timed(bot.report_ready)
+
+    open_connection = storage._open_connection
+
+    def traced_connection():
+        conn = open_connection()
+        conn.set_trace_callback(recorder.trace)
+        return conn
+
+    storage._open_connection = traced_connection
+
+
+def flow_steps(user_id, language, first_round):
+    # (update, handler calls to wait for) for one round of a user's flows
+    texts = bot.languages[language]
+    other = 'ru' if language == 'uz' else 'uz'
+    steps = []
+    if first_round:
+        steps += [
+            (message_update(user_id, '/start'), 1),
+            (callback_update(user_id, f'lang_{language}'), 1),
+        ]
+    steps += [
+        (message_update(user_id, texts['income']), 1),
+        (message_update(user_id, '1 500 000'), 1),
+        (callback_update(user_id, 'UZS'), 1),
+        (message_update(user_id, 'salary'), 1),
+        (message_update(user_id, texts['expense']), 1),
+        (message_update(user_id, '12.50'), 1),
+        (callback_update(user_id, 'USD'), 1),
+        (message_update(user_id, 'taxi'), 1),
+        # report_selection, then report_ready once the pool has built it
+        (message_update(user_id, texts['report']), 1),
+        (callback_update(user_id, 'weekly'), 2),
+        (message_update(user_id, texts['settings']), 1),
+        (callback_update(user_id, 'change_language'), 1),
+        (callback_update(user_id, f'lang_{other}'), 1),
+        # And back, so every round starts in the same language
+        (message_update(user_id, bot.languages[other]['settings']), 1),
+        (callback_update(user_id, 'change_language'), 1),
+        (callback_update(user_id, f'lang_{language}'), 1),
+    ]
+    return steps
+
+
+def drive(recorder, fake_bot, queue, users, rounds):
+    sent = [0]
+    errors = []
+    lock = threading.Lock()
+
+    def user(user_id):
+        language = 'uz' if user_id % 2 else 'ru'
+        count = 0
+        try:
+            for round_number in range(rounds):
+                for data, calls in flow_steps(user_id, language, round_number == 0):
+                    target = recorder.expect(user_id, calls)
+                    queue.put(Update.de_json(data, fake_bot))
+                    recorder.wait(user_id, target)
+                    count += 1
+        except Exception as e:
+            errors.append(e)
+        with lock:
+            sent[0] += count
+
+    threads = [threading.Thread(target=user, args=(user_id,)) for user_id in users]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return sent[0], elapsed
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+
+    recorder = Recorder()
+    fake_bot = FakeBot(latency=latency)
+    updater = Updater(bot=fake_bot, workers=bot.DISPATCHER_WORKERS, use_context=True)
+    bot.add_handlers(updater.dispatcher)
+    instrument(recorder, updater.dispatcher)
+    # Every user may have a report in flight, the default limit would turn some away
+    bot.report_pool = ReportPool(max_pending=n_users)
+    bot.init_db()
+
+    dispatcher_thread = start_dispatcher(updater)
+    try:
+        users = list(range(1, n_users + 1))
+        updates, elapsed = drive(recorder, fake_bot, updater.dispatcher.update_queue, users, rounds)
+    finally:
+        stop_dispatcher(updater, dispatcher_thread)
+        bot.report_pool.shutdown()
+        outbound.shutdown()
+        storage.close_all()
+
+    print(
+        f"{n_users} users x {rounds} rounds, {latency * 1000:.0f} ms per API call, "
+        f"{bot.DISPATCHER_WORKERS} dispatcher workers"
+    )
+    print(f"{updates} updates in {elapsed:.2f} s: {updates / elapsed:.0f} updates/s, "
+          f"{len(fake_bot.calls)} API calls")
+    print(f"{'handler':<28}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql/call':>10}")
+    for name in sorted(recorder.latencies):
+        values = sorted(recorder.latencies[name])
+        print(
+            f"{name:<28}{len(values):>7}"
+            f"{percentile(values, 0.50) * 1000:>9.1f}"
+            f"{percentile(values, 0.95) * 1000:>9.1f}"
+            f"{percentile(values, 0.99) * 1000:>9.1f}"
+            f"{recorder.queries[name] / len(values):>10.1f}"
+        )
+    if recorder.queries.get('(outside handlers)'):
+        print(f"SQL statements outside handlers: {recorder.queries['(outside handlers)']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Handler latency with serial vs background Telegram calls, against a fake bot
+that sleeps for a fixed network delay on every request.
+
+Usage: python benchmarks/bench_outbound.py [delay_ms] [iterations]
+"""
+import itertools
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import bot  # noqa: E402
+import outbound  # noqa: E402
+
+USER_ID = 1
+
+
+class FakeBot:
+    def __init__(self, delay):
+        self.delay = delay
+        self.message_ids = itertools.count(1000)
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.delay)
+        return SimpleNamespace(message_id=next(self.message_ids))
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        time.sleep(self.delay)
+        return True
+
+
+def make_update(text):
+    return SimpleNamespace(
+        message=SimpleNamespace(text=text, message_id=1),
+        effective_user=SimpleNamespace(id=USER_ID),
+        effective_chat=SimpleNamespace(id=USER_ID),
+    )
+
+
+def run_inline(description, func, *args, **kwargs):
+    # The old behaviour: every call blocks the handler
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        pass
+
+
+def measure(fake_bot, iterations):
+    context = SimpleNamespace(bot=fake_bot, user_data={'last_bot_message_id': 1})
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        bot.income_amount_received(make_update('100'), context)
+        timings.append(time.perf_counter() - start)
+    return sum(timings) / len(timings) * 1000
+
+
+def main():
+    delay_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    bot.init_db()
+    bot.set_user_language(USER_ID, 'uz')
+    fake_bot = FakeBot(delay_ms / 1000)
+
+    submit = outbound.submit
+    outbound.submit = run_inline
+    serial = measure(fake_bot, iterations)
+    outbound.submit = submit
+    concurrent = measure(fake_bot, iterations)
+    outbound.shutdown()
+    storage.close_all()
+
+    print(f"income_amount_received with {delay_ms:.0f} ms per API call")
+    print(f"serial:     {serial:8.1f} ms")
+    print(f"background: {concurrent:8.1f} ms")
+    # Two deletes and one send: only the send should be on the critical path
+    if concurrent > serial / 2:
+        print("background deletes did not cut handler latency")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""/search latency: the FTS5 index against a LIKE scan of the user's rows.
+
+Fills a temporary database (all migrations applied, so the transactions_fts
+triggers index every insert) with `rows` transactions spread over `users`
+users, plus one heavy user holding a tenth of them. Prints the insert rate
+with the index, then per query the median time of search.search() (totals
+and the first page) and of a LIKE over the same user's comments.
+
+Usage: python benchmarks/bench_search.py [rows] [users]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import categories  # noqa: E402
+import importer  # noqa: E402
+import migrations  # noqa: E402
+import search  # noqa: E402
+
+COMMON = ['taksi', 'bozor', 'oylik', 'obed', 'kommunal', 'ijara', 'kafe', 'benzin', 'такси', 'продукты']
+RARE = [f'soz{i}' for i in range(5000)]
+QUERIES = ['taksi', 'taksi bozor', 'soz17', 'такси']
+LIKE_QUERY = """
+    SELECT currency, kind, SUM(amount), COUNT(*)
+    FROM transactions
+    WHERE user_id = ? AND comment LIKE ?
+    GROUP BY currency, kind
+"""
+REPEAT = 5
+
+
+def fill(rows, users, heavy_user):
+    random.seed(1)
+    start = datetime(2020, 1, 1)
+    batch = []
+    with storage.transaction() as conn:
+        for i in range(rows):
+            user_id = heavy_user if i % 10 == 0 else random.randrange(users)
+            words = [random.choice(COMMON if random.random() < 0.5 else RARE) for _ in range(random.randint(1, 3))]
+            comment = ' '.join(words)
+            batch.append((
+                user_id,
+                random.choice(('income', 'expense')),
+                start + timedelta(seconds=30 * i),
+                random.randint(100, 10000000),
+                random.choice(('USD', 'UZS')),
+                comment,
+                categories.categorize(comment),
+            ))
+            if len(batch) == 10000:
+                conn.executemany(importer.TRANSACTION_INSERT, batch)
+                batch = []
+        conn.executemany(importer.TRANSACTION_INSERT, batch)
+
+
+def timed(func):
+    times = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1000, result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    heavy_user = users
+    conn = storage.get_connection()
+    migrations.migrate(conn)
+    started = time.perf_counter()
+    fill(rows, users, heavy_user)
+    elapsed = time.perf_counter() - started
+    print(f"{rows} rows, {users} users + one with {rows // 10}: inserted at {rows / elapsed:.0f} rows/s")
+
+    light_user = 3
+    print(f"{'user':<8}{'query':<14}{'matches':>9}{'fts ms':>9}{'like ms':>9}")
+    for label, user_id in (('light', light_user), ('heavy', heavy_user)):
+        for query in QUERIES:
+            fts_ms, result = timed(lambda: search.search(user_id, query))
+            # LIKE can only look for one substring, the first word
+            like_ms, _ = timed(
+                lambda: conn.execute(LIKE_QUERY, (user_id, f'%{query.split()[0]}%')).fetchall()
+            )
+            print(f"{label:<8}{query:<14}{result['count']:>9}{fts_ms:>9.2f}{like_ms:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
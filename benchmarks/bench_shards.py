@@ -0,0 +1,159 @@
+"""Throughput of the sharded webhook front-end with 1, 2, 4... worker processes.
+
+Synthetic "settings" menu taps from simulated users are POSTed to a local
+ShardedWebhookServer, which routes them by user id to worker processes
+running the real dispatcher and handlers on a shared database. Each worker
+talks to a fake bot that sleeps `api_latency_ms` per call, like the Bot API
+round trip that blocks a dispatcher thread, and reports every reply back to
+this process. A user sends the next tap after the reply to the previous one,
+and every reply has to come from the worker that owns the user.
+
+With api_latency_ms=0 the handlers are CPU bound and scaling stops at the
+number of cores.
+
+Usage: python benchmarks/bench_shards.py [users] [taps_per_user] [api_latency_ms] [workers,...]
+"""
+import http.client
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+if __name__ == '__main__':
+    storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['BENCH_DB'] = storage.DB_PATH
+else:
+    # Spawned worker
+    storage.DB_PATH = os.environ['BENCH_DB']
+
+from telegram.ext import Updater  # noqa: E402
+
+import bot  # noqa: E402
+from fakes import FakeBot, message_update  # noqa: E402
+from webhook import ShardedWebhookServer, serve_shard  # noqa: E402
+
+SECRET = 'bench-secret'
+PATH = '/telegram'
+
+
+def worker(index, shard_queue, workers, replies, latency):
+    fake_bot = FakeBot(latency=latency)
+
+    def on_call(name, chat_id):
+        if name == 'send_message':
+            replies.put((chat_id, index))
+
+    fake_bot.on_call = on_call
+    bot.PERSIST_STATE = False
+    updater = Updater(bot=fake_bot, workers=bot.DISPATCHER_WORKERS, use_context=True)
+    bot.add_handlers(updater.dispatcher)
+    serve_shard(updater, shard_queue)
+
+
+def run(workers, users, taps, latency):
+    context = multiprocessing.get_context('spawn')
+    replies = context.Queue()
+    queues = [context.Queue(1000) for _ in range(workers)]
+    processes = [
+        context.Process(target=worker, args=(index, queues[index], workers, replies, latency))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    server = ShardedWebhookServer(queues, '127.0.0.1', 0, PATH, secret_token=SECRET)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    events = {user_id: threading.Event() for user_id in users}
+    misrouted = []
+
+    def collect():
+        while True:
+            item = replies.get()
+            if item is None:
+                return
+            chat_id, index = item
+            if chat_id % workers != index:
+                misrouted.append(chat_id)
+            events[chat_id].set()
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+
+    def user(user_id):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        text = bot.languages['uz']['settings']
+        for _ in range(taps):
+            events[user_id].clear()
+            body = json.dumps(message_update(user_id, text))
+            conn.request(
+                'POST',
+                PATH,
+                body=body,
+                headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET},
+            )
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f'webhook answered {response.status}')
+            if not events[user_id].wait(60):
+                raise RuntimeError(f'no reply for user {user_id}')
+
+    # Warm up: first update of every user, workers import and connect
+    threads = [threading.Thread(target=user, args=(user_id,)) for user_id in users]
+    warm_taps, taps = taps, 1
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    taps = warm_taps
+
+    threads = [threading.Thread(target=user, args=(user_id,)) for user_id in users]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    server.server_close()
+    for shard_queue in queues:
+        shard_queue.put(None)
+    for process in processes:
+        process.join()
+    replies.put(None)
+    collector.join()
+    if misrouted:
+        raise RuntimeError(f'{len(misrouted)} replies came from the wrong worker')
+    return len(users) * taps / elapsed, server.routed
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    counts = [int(n) for n in (sys.argv[4] if len(sys.argv) > 4 else '1,2,4').split(',')]
+    bot.init_db()
+    users = range(1, n_users + 1)
+    for user_id in users:
+        bot.set_user_language(user_id, 'uz')
+    storage.close_all()
+    print(f"{n_users} users x {taps} taps, API latency {latency * 1000:.0f} ms, {os.cpu_count()} CPUs")
+    print(f"{'workers':<9}{'updates/s':>11}{'speedup':>9}  updates per worker")
+    baseline = None
+    for workers in counts:
+        throughput, routed = run(workers, users, taps, latency)
+        baseline = baseline or throughput
+        print(f"{workers:<9}{throughput:>11.0f}{throughput / baseline:>8.2f}x  {routed}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Cold start: import time and memory of bot.py before main() runs.
+
+Each run is a fresh interpreter started with -X importtime. Prints the median
+total import time and peak RSS over the runs, the packages with the largest
+self time, and which heavy optional packages ended up loaded. "eager" also
+imports openpyxl up front, the way reports.py and importer.py used to.
+
+Usage: python benchmarks/bench_startup.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY = ('openpyxl', 'pandas', 'numpy', 'tornado', 'apscheduler', 'pkg_resources')
+PROBE = (
+    'import resource, sys\n'
+    '{imports}\n'
+    'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n'
+    'print(",".join(m for m in {heavy!r} if m in sys.modules))\n'
+)
+MODES = {
+    'lazy': 'import bot',
+    'eager': 'import bot, openpyxl',
+}
+
+
+def run(imports):
+    # Returns (total import seconds, rss kb, {package: self seconds}, heavy modules loaded)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE.format(imports=imports, heavy=HEAVY)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    self_times = defaultdict(float)
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        self_times[name.strip().split('.')[0]] += int(self_us) / 1e6
+        if not name.startswith(' ' * 2):
+            # Top-level import, its cumulative time includes everything below it
+            total += int(cumulative_us) / 1e6
+    rss, loaded = result.stdout.splitlines()
+    return total, int(rss), self_times, loaded.split(',') if loaded else []
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{runs} runs per mode")
+    print(f"{'mode':<8}{'import ms':>11}{'RSS MB':>9}  heavy modules loaded")
+    packages = {}
+    for mode, imports in MODES.items():
+        results = [run(imports) for _ in range(runs)]
+        total = statistics.median(r[0] for r in results)
+        rss = statistics.median(r[1] for r in results)
+        print(f"{mode:<8}{total * 1000:>11.0f}{rss / 1024:>9.1f}  {', '.join(results[-1][3]) or '-'}")
+        packages[mode] = results[-1][2]
+    print("\nslowest packages (lazy, self time of all their modules):")
+    for name, seconds in sorted(packages['lazy'].items(), key=lambda item: -item[1])[:10]:
+        print(f"  {name:<24}{seconds * 1000:>8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
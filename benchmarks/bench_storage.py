@@ -0,0 +1,91 @@
+"""Per-call latency of the DB helpers: connect-per-call vs the shared storage layer.
+
+Usage: python benchmarks/bench_storage.py [iterations]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+SCHEMA = [
+    'CREATE TABLE users (user_id INTEGER PRIMARY KEY, language TEXT, first_time BOOLEAN DEFAULT 1)',
+    '''CREATE TABLE incomes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        date TIMESTAMP,
+        amount REAL,
+        currency TEXT,
+        comment TEXT
+    )''',
+]
+SELECT_SQL = 'SELECT language FROM users WHERE user_id = ?'
+INSERT_SQL = 'INSERT INTO incomes (user_id, date, amount, currency, comment) VALUES (?, ?, ?, ?, ?)'
+
+
+def old_select(path, user_id):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute(SELECT_SQL, (user_id,))
+    result = c.fetchone()
+    conn.close()
+    return result
+
+
+def old_insert(path, user_id):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute(INSERT_SQL, (user_id, datetime.now(), 100.0, 'USD', 'bench'))
+    conn.commit()
+    conn.close()
+
+
+def new_select(path, user_id):
+    return storage.fetchone(SELECT_SQL, (user_id,))
+
+
+def new_insert(path, user_id):
+    storage.execute(INSERT_SQL, (user_id, datetime.now(), 100.0, 'USD', 'bench'))
+
+
+def measure(func, path, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(path, i % 100)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path = os.path.join(tmp, 'old.db')
+        new_path = os.path.join(tmp, 'new.db')
+        for path in (old_path, new_path):
+            conn = sqlite3.connect(path)
+            for sql in SCHEMA:
+                conn.execute(sql)
+            conn.executemany(
+                'INSERT INTO users (user_id, language) VALUES (?, ?)', [(i, 'uz') for i in range(100)]
+            )
+            conn.commit()
+            conn.close()
+
+        storage.DB_PATH = new_path
+        results = [
+            ('select', measure(old_select, old_path, iterations), measure(new_select, new_path, iterations)),
+            ('insert', measure(old_insert, old_path, iterations), measure(new_insert, new_path, iterations)),
+        ]
+        storage.close_all()
+
+    print(f"{'call':<8}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name, before, after in results:
+        print(f"{name:<8}{before:>14.1f}{after:>14.1f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
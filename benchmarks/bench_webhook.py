@@ -0,0 +1,153 @@
+"""Updates/sec and end-to-end latency, webhook ingestion vs long polling.
+
+Synthetic "settings" menu taps from simulated users go through the real
+dispatcher and handlers. A fake bot stands in for Telegram: in polling mode it
+serves getUpdates (with an optional round trip delay), in webhook mode the
+updates are POSTed to the local WebhookServer. Latency is measured from
+sending an update to the bot's reply.
+
+Usage: python benchmarks/bench_webhook.py [users] [taps_per_user] [poll_rtt_ms]
+"""
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage  # noqa: E402
+
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from telegram.ext import Updater  # noqa: E402
+
+import bot  # noqa: E402
+import outbound  # noqa: E402
+from fakes import FakeBot, message_update  # noqa: E402
+from webhook import WebhookServer, start_dispatcher, stop_dispatcher  # noqa: E402
+
+SECRET = 'bench-secret'
+PATH = '/telegram'
+
+
+def make_updater(fake_bot):
+    updater = Updater(bot=fake_bot, workers=bot.DISPATCHER_WORKERS, use_context=True)
+    bot.add_handlers(updater.dispatcher)
+    replies = {}
+
+    def on_call(name, chat_id):
+        if name == 'send_message' and chat_id in replies:
+            replies[chat_id].set()
+
+    fake_bot.on_call = on_call
+    return updater, replies
+
+
+def drive(users, taps, replies, send):
+    # Each simulated user taps, waits for the reply, taps again
+    text = bot.languages['uz']['settings']
+    latencies = []
+    lock = threading.Lock()
+
+    def user(user_id):
+        own = []
+        for _ in range(taps):
+            replies[user_id].clear()
+            start = time.perf_counter()
+            send(user_id, message_update(user_id, text))
+            if not replies[user_id].wait(30):
+                raise RuntimeError(f'no reply for user {user_id}')
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    for user_id in users:
+        replies[user_id] = threading.Event()
+    threads = [threading.Thread(target=user, args=(user_id,)) for user_id in users]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies) / (time.perf_counter() - start), latencies
+
+
+def run_polling(users, taps, poll_rtt):
+    fake_bot = FakeBot(poll_latency=poll_rtt)
+    updater, replies = make_updater(fake_bot)
+    updater.start_polling(poll_interval=0, timeout=10)
+    try:
+        return drive(users, taps, replies, lambda user_id, data: fake_bot.push_update(data))
+    finally:
+        fake_bot.push_update(message_update(0, '/noop'))
+        updater.stop()
+
+
+def run_webhook(users, taps):
+    fake_bot = FakeBot()
+    updater, replies = make_updater(fake_bot)
+    server = WebhookServer(updater.dispatcher, '127.0.0.1', 0, PATH, secret_token=SECRET)
+    port = server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    dispatcher_thread = start_dispatcher(updater)
+    local = threading.local()
+
+    def post(user_id, data):
+        if not hasattr(local, 'conn'):
+            local.conn = http.client.HTTPConnection('127.0.0.1', port)
+        body = json.dumps(data)
+        local.conn.request(
+            'POST',
+            PATH,
+            body=body,
+            headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET},
+        )
+        response = local.conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f'webhook answered {response.status}')
+
+    try:
+        return drive(users, taps, replies, post)
+    finally:
+        server.shutdown()
+        server.server_close()
+        stop_dispatcher(updater, dispatcher_thread)
+
+
+def summary(name, throughput, latencies):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    mean = statistics.mean(latencies) * 1000
+    print(f"{name:<10}{throughput:>12.0f}{mean:>10.1f}{p50:>10.1f}{p95:>10.1f}")
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    poll_rtt = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    bot.init_db()
+    users = list(range(1, n_users + 1))
+    for user_id in users:
+        bot.set_user_language(user_id, 'uz')
+        bot.profile_cache.update(user_id, first_time=False)
+
+    polling = run_polling(users, taps, poll_rtt)
+    webhook = run_webhook(users, taps)
+    outbound.shutdown()
+    storage.close_all()
+
+    print(f"{n_users} users x {taps} taps, simulated getUpdates round trip {poll_rtt * 1000:.0f} ms")
+    print(f"{'mode':<10}{'updates/s':>12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    summary('polling', *polling)
+    summary('webhook', *webhook)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Telegram stand-ins for the benchmarks: a fake Bot and synthetic update payloads."""
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+from telegram import Update
+
+
+class FakeBot:
+    # Records every API call, sleeps `latency` seconds per call to stand in for
+    # the network, and serves getUpdates from updates pushed with push_update()
+
+    def __init__(self, latency=0.0, poll_latency=0.0):
+        self.latency = latency
+        self.poll_latency = poll_latency
+        self.defaults = None
+        self.id = 1
+        self.username = 'fake_bot'
+        self.first_name = 'Fake'
+        self.request = SimpleNamespace(con_pool_size=64)
+        self.calls = []
+        self.on_call = None
+        self._message_ids = itertools.count(100000)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_cond = threading.Condition()
+
+    def _call(self, name, chat_id=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append((name, chat_id, time.perf_counter()))
+        if self.on_call is not None:
+            self.on_call(name, chat_id)
+        return SimpleNamespace(
+            message_id=next(self._message_ids),
+            document=SimpleNamespace(file_id=f'file-{next(self._message_ids)}'),
+        )
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call('send_message', chat_id)
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self._call('send_document', chat_id)
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, **kwargs):
+        return self._call('edit_message_text', chat_id)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        return self._call('delete_message', chat_id)
+
+    def answer_callback_query(self, callback_query_id=None, **kwargs):
+        return self._call('answer_callback_query')
+
+    def get_me(self, **kwargs):
+        return self
+
+    def set_webhook(self, *args, **kwargs):
+        return True
+
+    def delete_webhook(self, *args, **kwargs):
+        return True
+
+    def push_update(self, data):
+        with self._pending_cond:
+            self._pending.append(data)
+            self._pending_cond.notify_all()
+
+    def get_updates(self, offset=None, timeout=0, **kwargs):
+        # Long polling: wait up to `timeout` for pending updates, then one round trip
+        deadline = time.monotonic() + (timeout or 0)
+        with self._pending_cond:
+            while not self._pending and time.monotonic() < deadline:
+                self._pending_cond.wait(deadline - time.monotonic())
+            batch, self._pending = self._pending[:100], self._pending[100:]
+        if self.poll_latency:
+            time.sleep(self.poll_latency)
+        return [Update.de_json(data, self) for data in batch]
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def message_update(user_id, text):
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id, data):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'chat_instance': str(user_id),
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'message': {
+                'message_id': next(_message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': '',
+            },
+        },
+    }
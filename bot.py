@@ -1,10 +1,14 @@
-import os
-import pandas as pd
 import logging
-import sqlite3
-from datetime import datetime
+import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import date, datetime
+from io import BytesIO
 
 from telegram import (
+    TelegramError,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -20,12 +24,80 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
 )
+from telegram.utils.request import Request
+
+import categories
+import export
+import importer
+import metrics
+import migrations
+import outbound
+import rates
+import reports
+import search
+import storage
+from amounts import from_minor_units, parse_amount, to_exact_minor_units
+from cache import ProfileCache, ReportCache
+from comments import sanitize_comment
+from importer import DAILY_TOTALS_UPSERT, TRANSACTION_INSERT
+from metrics import MetricsServer
+from persistence import SQLitePersistence
+from rate_limit import GLOBAL_BURST, GLOBAL_RATE, RateLimitedBot, RateLimiter
+from report_pool import ReportPool, ReportQueueFull
+from webhook import run_sharded_webhook, run_webhook, serve_shard
+from write_queue import WriteBehindQueue
 
 logging.basicConfig(level=logging.INFO)
 
 # Replace 'YOUR_TELEGRAM_BOT_TOKEN_HERE' with your actual bot token>>
 TOKEN = 'YOUR-BOT-TOKEN-HERE'
 
+# Commit income/expense inserts in batches from a single writer thread
+# instead of one transaction per entry on the handler thread
+WRITE_BEHIND = False
+
+# Dispatcher threads for run_async callbacks (finished reports)
+DISPATCHER_WORKERS = 4
+
+# Receive updates on a built-in HTTP server instead of long polling getUpdates.
+# Telegram needs HTTPS, so put the listener behind a TLS terminating proxy.
+USE_WEBHOOK = False
+WEBHOOK_URL = ''  # public base URL, e.g. 'https://bot.example.com', empty to skip set_webhook
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+# Telegram sends it back in X-Telegram-Bot-Api-Secret-Token with every update,
+# updates without it are refused. Empty: a random one per start, which needs
+# WEBHOOK_URL so the webhook is registered with it.
+WEBHOOK_SECRET = ''
+# Webhook only: with more than 1, the webhook server only routes updates to
+# this many worker processes by user id, each with its own dispatcher. They
+# share the database and split the Bot API rate limit between them.
+SHARD_WORKERS = 1
+
+# Keep user_data and conversation states in the database so half-finished
+# entries survive a restart
+PERSIST_STATE = True
+
+# Telegram user ids allowed to set exchange rates with /rate
+ADMIN_IDS = set()
+# CSV of exchange rates (date,currency,rate) loaded at startup, empty to skip
+RATES_FILE = ''
+
+# Largest CSV/XLSX accepted for import, the Bot API can't download bigger files
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+# Imported files up to this size are kept in memory, bigger ones in a temp file
+IMPORT_SPOOL_BYTES = 1024 * 1024
+# Compressed history exports are kept in memory up to this size, then spill to disk
+EXPORT_SPOOL_BYTES = 4 * 1024 * 1024
+
+# Prometheus metrics (handler, SQL, Bot API and report timings) on
+# http://METRICS_LISTEN:METRICS_PORT/metrics, 0 to disable
+METRICS_PORT = 0
+METRICS_LISTEN = '127.0.0.1'
+# Log updates whose handler takes longer than this, 0 to disable
+SLOW_UPDATE_MS = 0
+
 # States
 (
     LANGUAGE_SELECTION,
@@ -40,84 +112,58 @@ TOKEN = 'YOUR-BOT-TOKEN-HERE'
 
 # Database functions
 def init_db():
-    conn = sqlite3.connect('bot_database.db')
-    c = conn.cursor()
-    # Create tables
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS users (
-                        user_id INTEGER PRIMARY KEY,
-                        language TEXT,
-                        first_time BOOLEAN DEFAULT 1
-                    )'''
-    )
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS incomes (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        date TIMESTAMP,
-                        amount REAL,
-                        currency TEXT,
-                        comment TEXT,
-                        FOREIGN KEY(user_id) REFERENCES users(user_id)
-                    )'''
-    )
-    c.execute(
-        '''CREATE TABLE IF NOT EXISTS expenses (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        date TIMESTAMP,
-                        amount REAL,
-                        currency TEXT,
-                        comment TEXT,
-                        FOREIGN KEY(user_id) REFERENCES users(user_id)
-                    )'''
-    )
-    conn.commit()
-    conn.close()
+    # Brings the schema up to date, runs once at startup
+    start = time.perf_counter()
+    version = migrations.migrate(storage.get_connection())
+    logging.info(f"Database schema at version {version}, migrations took {(time.perf_counter() - start) * 1000:.1f} ms")
 
 
-def get_user_language(user_id):
-    conn = sqlite3.connect('bot_database.db')
-    c = conn.cursor()
-    c.execute('SELECT language FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
+def load_user_profile(user_id):
+    result = storage.fetchone('SELECT language, first_time FROM users WHERE user_id = ?', (user_id,))
     if result:
-        return result[0]
+        return {'language': result[0], 'first_time': bool(result[1])}
     else:
-        return None
+        # Default to first_time = True if user not found
+        return {'language': None, 'first_time': True}
+
+
+# User profiles are read on every update, keep them in memory
+profile_cache = ProfileCache(load_user_profile)
+
+# Reports are built in worker processes so they don't block other updates
+report_pool = ReportPool()
+
+# Finished reports, reused until the user saves a new transaction
+report_cache = ReportCache()
+
+write_queue = WriteBehindQueue() if WRITE_BEHIND else None
+
+
+def get_user_language(user_id):
+    return profile_cache.get(user_id)['language']
 
 
 def set_user_language(user_id, language):
-    conn = sqlite3.connect('bot_database.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    if result:
-        # User exists, update language and set first_time to False
-        c.execute(
-            'UPDATE users SET language = ?, first_time = 0 WHERE user_id = ?', (language, user_id)
-        )
-    else:
-        # New user, insert record with first_time = 1
-        c.execute(
-            'INSERT INTO users (user_id, language, first_time) VALUES (?, ?, 1)',
-            (user_id, language),
-        )
-    conn.commit()
-    conn.close()
+    with storage.transaction() as conn:
+        c = conn.cursor()
+        c.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+        result = c.fetchone()
+        if result:
+            # User exists, update language and set first_time to False
+            c.execute(
+                'UPDATE users SET language = ?, first_time = 0 WHERE user_id = ?', (language, user_id)
+            )
+        else:
+            # New user, insert record with first_time = 1
+            c.execute(
+                'INSERT INTO users (user_id, language, first_time) VALUES (?, ?, 1)',
+                (user_id, language),
+            )
+    profile_cache.put(user_id, {'language': language, 'first_time': not result})
 
 
 def is_first_time_user(user_id):
-    conn = sqlite3.connect('bot_database.db')
-    c = conn.cursor()
-    c.execute('SELECT first_time FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result:
-        return bool(result[0])
-    else:
-        return True  # Default to True if user not found
+    return profile_cache.get(user_id)['first_time']
 
 
 # Language dictionary
@@ -138,6 +184,33 @@ languages = {
         'choose_report': "Qaysi hisobotni ko'rmoqchisiz?",
         'weekly': "Haftalik",
         'monthly': "Oylik",
+        'this_month': "Joriy oy",
+        'last_month': "O'tgan oy",
+        'year': "Yil boshidan",
+        'export_all': "📦Butun tarix (CSV)",
+        'custom_report_hint': "Boshqa davr uchun: /report 2026-01-01 2026-03-31",
+        'invalid_report_range': "Sanalarni YYYY-MM-DD ko'rinishida kiriting: /report 2026-01-01 2026-03-31",
+        'rate_saved': "✅Kurs saqlandi: 1 {currency} = {rate} ({day})",
+        'invalid_rate': "Kursni shunday kiriting: /rate USD 12650.50 [2026-10-01]",
+        'search_hint': "Kommentariyalardan qidirish: /search taksi",
+        'search_found': "🔎 «{query}»: {count} ta yozuv",
+        'search_totals': "{currency}: kirim {income}, chiqim {expense}",
+        'search_nothing': "🔎 «{query}» bo'yicha hech narsa topilmadi.",
+        'search_page': "{page}/{pages}-sahifa",
+        'import_started': "⏳Fayl import qilinmoqda...",
+        'import_done': "✅Import qilindi: {imported} ta yozuv, rad etildi: {rejected} ta.",
+        'import_row_error': "{line}-qator: noto'g'ri {column}",
+        'import_columns': {
+            'columns': "ustunlar soni",
+            'date': "sana",
+            'type': "tur",
+            'amount': "summa",
+            'currency': "valyuta",
+        },
+        'import_unsupported': "CSV yoki XLSX fayl yuboring, ustunlar: sana, tur (kirim/chiqim), summa, valyuta, kommentariya.",
+        'import_too_large': "Fayl juda katta, 20 MB dan kichik fayl yuboring.",
+        'import_busy': "Oldingi fayl hali yuklanmoqda, birozdan so'ng qayta yuboring.",
+        'import_failed': "Faylni o'qib bo'lmadi.",
         'report_sent': "✅Hisobot yuborildi",
         'operation_cancelled': "❌Amal bekor qilindi.",
         'incorrect_selection': "Noto'g'ri tanlov.",
@@ -146,7 +219,12 @@ languages = {
         'change_language': "Tilni o'zgartirish",
         'select_language': "Tanlovni bajaring:",
         'invalid_amount': "Iltimos, to'g'ri summa kiriting:",
+        'invalid_amount_for_currency': "Bu summa {currency} uchun to'g'ri emas, summani qaytadan kiriting:",
         'no_data': "Hisobot uchun ma'lumot topilmadi.",
+        'generating_report': "⏳Hisobot tayyorlanmoqda...",
+        'generating_export': "⏳Tarix yuklanmoqda...",
+        'export_sent': "✅Tarix yuborildi: {rows} ta yozuv",
+        'report_busy': "Hisobot hozir tayyorlanmoqda, birozdan so'ng qayta urinib ko'ring.",
     },
     'ru': {
         'start_message_new': "Здравствуйте! 😃 \nВыберите нужный раздел:",
@@ -164,6 +242,33 @@ languages = {
         'choose_report': "Какой отчет вы хотите посмотреть?",
         'weekly': "Еженедельный",
         'monthly': "Ежемесячный",
+        'this_month': "Текущий месяц",
+        'last_month': "Прошлый месяц",
+        'year': "С начала года",
+        'export_all': "📦Вся история (CSV)",
+        'custom_report_hint': "Другой период: /report 2026-01-01 2026-03-31",
+        'invalid_report_range': "Укажите даты в формате ГГГГ-ММ-ДД: /report 2026-01-01 2026-03-31",
+        'rate_saved': "✅Курс сохранен: 1 {currency} = {rate} ({day})",
+        'invalid_rate': "Укажите курс так: /rate USD 12650.50 [2026-10-01]",
+        'search_hint': "Поиск по комментариям: /search такси",
+        'search_found': "🔎 «{query}»: {count} записей",
+        'search_totals': "{currency}: доход {income}, расход {expense}",
+        'search_nothing': "🔎 По запросу «{query}» ничего не найдено.",
+        'search_page': "Страница {page}/{pages}",
+        'import_started': "⏳Импорт файла...",
+        'import_done': "✅Импортировано записей: {imported}, отклонено: {rejected}.",
+        'import_row_error': "Строка {line}: неверное поле «{column}»",
+        'import_columns': {
+            'columns': "число столбцов",
+            'date': "дата",
+            'type': "тип",
+            'amount': "сумма",
+            'currency': "валюта",
+        },
+        'import_unsupported': "Отправьте файл CSV или XLSX со столбцами: дата, тип (доход/расход), сумма, валюта, комментарий.",
+        'import_too_large': "Файл слишком большой, отправьте файл меньше 20 МБ.",
+        'import_busy': "Предыдущий файл еще загружается, отправьте файл чуть позже.",
+        'import_failed': "Не удалось прочитать файл.",
         'report_sent': "✅Отчет отправлен",
         'operation_cancelled': "❌Операция отменена.",
         'incorrect_selection': "Неправильный выбор.",
@@ -172,7 +277,12 @@ languages = {
         'change_language': "Изменить язык",
         'select_language': "Сделайте выбор:",
         'invalid_amount': "Пожалуйста, введите корректную сумму:",
+        'invalid_amount_for_currency': "Эта сумма не подходит для {currency}, введите сумму заново:",
         'no_data': "Данные для отчета не найдены.",
+        'generating_report': "⏳Отчет формируется...",
+        'generating_export': "⏳История выгружается...",
+        'export_sent': "✅История отправлена: {rows} записей",
+        'report_busy': "Отчет уже формируется, попробуйте чуть позже.",
     },
 }
 
@@ -185,23 +295,29 @@ def get_translation(user_id, key):
         return languages['uz'].get(key, '')
 
 
+# Deletes don't return anything the handlers need, so they run in the background
+# while the handler goes on with the sends whose message_id it has to keep
 def delete_previous_bot_message(update: Update, context: CallbackContext):
     if 'last_bot_message_id' in context.user_data:
-        try:
-            context.bot.delete_message(
-                chat_id=update.effective_chat.id, message_id=context.user_data['last_bot_message_id']
-            )
-        except Exception as e:
-            logging.warning(f"Failed to delete bot message: {e}")
+        return outbound.submit(
+            'delete bot message',
+            context.bot.delete_message,
+            chat_id=update.effective_chat.id,
+            message_id=context.user_data['last_bot_message_id'],
+        )
 
 
 def delete_user_message(update: Update, context: CallbackContext):
-    try:
-        context.bot.delete_message(
-            chat_id=update.effective_chat.id, message_id=update.message.message_id
-        )
-    except Exception as e:
-        logging.warning(f"Failed to delete user message: {e}")
+    return outbound.submit(
+        'delete user message',
+        context.bot.delete_message,
+        chat_id=update.effective_chat.id,
+        message_id=update.message.message_id,
+    )
+
+
+def answer_callback_query(update: Update):
+    return outbound.submit_urgent('answer callback query', update.callback_query.answer)
 
 
 def delete_message(context: CallbackContext):
@@ -215,7 +331,6 @@ def delete_message(context: CallbackContext):
 
 
 def start(update: Update, context: CallbackContext):
-    init_db()  # Initialize the database
     user_id = update.effective_user.id
     language = get_user_language(user_id)
     if language is None:
@@ -237,7 +352,7 @@ def start(update: Update, context: CallbackContext):
 
 def language_selection(update: Update, context: CallbackContext):
     query = update.callback_query
-    query.answer()
+    answer_callback_query(update)
     user_id = update.effective_user.id
     data = query.data
     if data == 'lang_uz':
@@ -268,11 +383,8 @@ def show_main_menu(update: Update, context: CallbackContext, language):
     if first_time:
         message_text = languages[language]['start_message_new']
         # Update first_time to False after greeting
-        conn = sqlite3.connect('bot_database.db')
-        c = conn.cursor()
-        c.execute('UPDATE users SET first_time = 0 WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        storage.execute('UPDATE users SET first_time = 0 WHERE user_id = ?', (user_id,))
+        profile_cache.update(user_id, first_time=False)
     else:
         message_text = languages[language]['start_message_returning']
 
@@ -323,7 +435,7 @@ def settings(update: Update, context: CallbackContext):
 
 def settings_selection(update: Update, context: CallbackContext):
     query = update.callback_query
-    query.answer()
+    answer_callback_query(update)
     data = query.data
     user_id = update.effective_user.id
     language = get_user_language(user_id)
@@ -369,9 +481,9 @@ def income_amount_received(update: Update, context: CallbackContext):
         cancel(update, context)
         return ConversationHandler.END
 
-    # Validate that the input is a number
+    # Validate the amount, thousands separators like "1 000 000" are accepted
     try:
-        amount = float(user_input)
+        amount = parse_amount(user_input)
         context.user_data['income_amount'] = amount
         delete_user_message(update, context)
         delete_previous_bot_message(update, context)
@@ -403,13 +515,37 @@ def income_amount_received(update: Update, context: CallbackContext):
     return INCOME_CURRENCY
 
 
+def amount_fits_currency(amount, currency):
+    # The amount has no more decimals than the currency and isn't 0 in it
+    try:
+        to_exact_minor_units(amount, currency)
+    except ValueError:
+        return False
+    return True
+
+
+def ask_amount_again(update: Update, context: CallbackContext, language, currency):
+    keyboard = [[languages[language]['cancel']]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    message = context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=languages[language]['invalid_amount_for_currency'].format(currency=currency),
+        reply_markup=reply_markup,
+    )
+    context.user_data['last_bot_message_id'] = message.message_id
+
+
 def income_currency_received(update: Update, context: CallbackContext):
     query = update.callback_query
     context.user_data['income_currency'] = query.data
-    query.answer()
+    answer_callback_query(update)
     delete_previous_bot_message(update, context)
     user_id = update.effective_user.id
     language = get_user_language(user_id)
+    if not amount_fits_currency(context.user_data['income_amount'], query.data):
+        # 0.4 UZS, 1500.50 UZS: ask for the amount again
+        ask_amount_again(update, context, language, query.data)
+        return INCOME_AMOUNT
     keyboard = [[languages[language]['cancel']]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     message_text = languages[language]['enter_comment']
@@ -469,9 +605,9 @@ def expense_amount_received(update: Update, context: CallbackContext):
         cancel(update, context)
         return ConversationHandler.END
 
-    # Validate that the input is a number
+    # Validate the amount, thousands separators like "1 000 000" are accepted
     try:
-        amount = float(user_input)
+        amount = parse_amount(user_input)
         context.user_data['expense_amount'] = amount
         delete_user_message(update, context)
         delete_previous_bot_message(update, context)
@@ -506,10 +642,14 @@ def expense_amount_received(update: Update, context: CallbackContext):
 def expense_currency_received(update: Update, context: CallbackContext):
     query = update.callback_query
     context.user_data['expense_currency'] = query.data
-    query.answer()
+    answer_callback_query(update)
     delete_previous_bot_message(update, context)
     user_id = update.effective_user.id
     language = get_user_language(user_id)
+    if not amount_fits_currency(context.user_data['expense_amount'], query.data):
+        # 0.4 UZS, 1500.50 UZS: ask for the amount again
+        ask_amount_again(update, context, language, query.data)
+        return EXPENSE_AMOUNT
     keyboard = [[languages[language]['cancel']]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     message_text = languages[language]['enter_comment']
@@ -548,13 +688,21 @@ def expense_comment_received(update: Update, context: CallbackContext):
 
 def report_start(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    language = get_user_language(user_id)
+    language = get_user_language(user_id) or 'uz'
     keyboard = [
-        [InlineKeyboardButton(languages[language]['weekly'], callback_data='weekly')],
-        [InlineKeyboardButton(languages[language]['monthly'], callback_data='monthly')],
+        [
+            InlineKeyboardButton(languages[language]['weekly'], callback_data='weekly'),
+            InlineKeyboardButton(languages[language]['monthly'], callback_data='monthly'),
+        ],
+        [
+            InlineKeyboardButton(languages[language]['this_month'], callback_data='this_month'),
+            InlineKeyboardButton(languages[language]['last_month'], callback_data='last_month'),
+        ],
+        [InlineKeyboardButton(languages[language]['year'], callback_data='year')],
+        [InlineKeyboardButton(languages[language]['export_all'], callback_data='export')],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    message_text = languages[language]['choose_report']
+    message_text = languages[language]['choose_report'] + '\n' + languages[language]['custom_report_hint']
     chat_id = update.effective_chat.id
     message = context.bot.send_message(
         chat_id=chat_id, text=message_text, reply_markup=reply_markup
@@ -566,247 +714,418 @@ def report_start(update: Update, context: CallbackContext):
 def report_selection(update: Update, context: CallbackContext):
     query = update.callback_query
     selection = query.data
-    query.answer()
+    answer_callback_query(update)
+    delete_previous_bot_message(update, context)
+    return request_report(update, context, selection)
+
+
+# Users with an export in progress, one at a time each
+exports_running = set()
+exports_lock = threading.Lock()
+
+
+def export_selection(update: Update, context: CallbackContext):
+    answer_callback_query(update)
     delete_previous_bot_message(update, context)
     user_id = update.effective_user.id
-    language = get_user_language(user_id)
+    language = get_user_language(user_id) or 'uz'
+    chat_id = update.effective_chat.id
+    with exports_lock:
+        busy = user_id in exports_running
+        exports_running.add(user_id)
+    if busy:
+        message = context.bot.send_message(chat_id=chat_id, text=languages[language]['report_busy'])
+        context.user_data['last_bot_message_id'] = message.message_id
+        return ConversationHandler.END
+    message = context.bot.send_message(chat_id=chat_id, text=languages[language]['generating_export'])
+    context.dispatcher.run_async(
+        send_export, update, context, message.message_id, language, update=update
+    )
+    return ConversationHandler.END
 
+
+def send_export(update: Update, context: CallbackContext, progress_message_id, language):
+    # The full history as gzip csv, streamed from the cursor into a spooled
+    # file so memory stays flat however many rows the user has
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     try:
-        file_name = create_report(user_id, selection, language)
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as f:
+            with metrics.timer('bot_report_phase_seconds', 'phase', 'export'):
+                file_name, rows = export.export_history(user_id, language, f)
+            if not rows:
+                message_text = languages[language]['no_data']
+                context.bot.edit_message_text(chat_id=chat_id, message_id=progress_message_id, text=message_text)
+                context.user_data['last_bot_message_id'] = progress_message_id
+                return
+            f.seek(0)
+            with metrics.timer('bot_report_phase_seconds', 'phase', 'upload'):
+                context.bot.send_document(chat_id=chat_id, document=f, filename=file_name)
     except Exception as e:
-        logging.error(f"Error generating report: {e}")
+        logging.error(f"Error exporting history for user {user_id}: {e}")
         message_text = languages[language]['error_generating_report']
-        chat_id = update.effective_chat.id
-        message = context.bot.send_message(chat_id=chat_id, text=message_text)
+        context.bot.edit_message_text(chat_id=chat_id, message_id=progress_message_id, text=message_text)
+        context.user_data['last_bot_message_id'] = progress_message_id
+        return
+    finally:
+        with exports_lock:
+            exports_running.discard(user_id)
+    message_text = languages[language]['export_sent'].format(rows=rows)
+    context.bot.edit_message_text(chat_id=chat_id, message_id=progress_message_id, text=message_text)
+    context.job_queue.run_once(
+        delete_message, 3, context={'chat_id': chat_id, 'message_id': progress_message_id}
+    )
+    show_main_menu(update, context, language)
+
+
+# Years a /report range may span, 9999-12-31 would overflow period_range()
+REPORT_YEARS = (1900, 2100)
+
+
+def parse_report_range(args):
+    # ['2026-01-01', '2026-03-31'] -> (date, date), both days included
+    if len(args) != 2:
+        raise ValueError('expected two dates')
+    first_day, last_day = (datetime.strptime(arg, '%Y-%m-%d').date() for arg in args)
+    if last_day < first_day:
+        raise ValueError('range ends before it starts')
+    if first_day.year < REPORT_YEARS[0] or last_day.year > REPORT_YEARS[1]:
+        raise ValueError('range outside the supported years')
+    return first_day, last_day
+
+
+def report_command(update: Update, context: CallbackContext):
+    # /report shows the period menu, /report 2026-01-01 2026-03-31 builds that range
+    if not context.args:
+        return report_start(update, context)
+    delete_user_message(update, context)
+    delete_previous_bot_message(update, context)
+    try:
+        period = parse_report_range(context.args)
+    except ValueError:
+        user_id = update.effective_user.id
+        message_text = languages[get_user_language(user_id) or 'uz']['invalid_report_range']
+        message = context.bot.send_message(chat_id=update.effective_chat.id, text=message_text)
         context.user_data['last_bot_message_id'] = message.message_id
         return ConversationHandler.END
+    return request_report(update, context, period)
 
-    # Send the file
-    if file_name and os.path.isfile(file_name):
-        with open(file_name, 'rb') as f:
-            context.bot.send_document(chat_id=update.effective_chat.id, document=f)
+
+def request_report(update: Update, context: CallbackContext, period):
+    # period is one of reports.PERIODS or a (first_day, last_day) tuple
+    user_id = update.effective_user.id
+    language = get_user_language(user_id) or 'uz'
+    chat_id = update.effective_chat.id
+
+    # Rates may have changed in another shard worker or through rates.py, seen
+    # within rates.VERSION_CHECK_INTERVAL
+    report_cache.set_generation(rates.rates_cache.version())
+    cache_key = report_cache.key(user_id, period, language)
+    cached = report_cache.get(cache_key)
+    if cached is not None:
+        # Nothing changed since the last build, resend the same file
+        send_report_document(context, chat_id, cache_key, cached['file_name'], cached['data'], cached['file_id'])
         # Send notification and delete after 3 seconds
-        chat_id = update.effective_chat.id
         message_text = languages[language]['report_sent']
         message = context.bot.send_message(chat_id=chat_id, text=message_text)
         context.job_queue.run_once(
             delete_message, 3, context={'chat_id': chat_id, 'message_id': message.message_id}
         )
-        # Remove the file after sending
-        os.remove(file_name)
         # Return to main menu
         show_main_menu(update, context, language)
-    else:
-        message_text = languages[language]['no_data']
-        chat_id = update.effective_chat.id
+        return ConversationHandler.END
+
+    try:
+        future = report_pool.submit(user_id, period, language)
+    except ReportQueueFull as e:
+        logging.warning(f"Report request rejected: {e}")
+        message_text = languages[language]['report_busy']
+        message = context.bot.send_message(chat_id=chat_id, text=message_text)
+        context.user_data['last_bot_message_id'] = message.message_id
+        return ConversationHandler.END
+    except Exception as e:
+        logging.error(f"Error starting report for user {user_id}: {e}")
+        message_text = languages[language]['error_generating_report']
         message = context.bot.send_message(chat_id=chat_id, text=message_text)
         context.user_data['last_bot_message_id'] = message.message_id
+        return ConversationHandler.END
+
+    # Reply right away, the message is replaced once the report is built
+    message_text = languages[language]['generating_report']
+    message = context.bot.send_message(chat_id=chat_id, text=message_text)
+    future.add_done_callback(
+        lambda f: context.dispatcher.run_async(
+            report_ready, update, context, f, message.message_id, language, cache_key, update=update
+        )
+    )
+    return ConversationHandler.END
+
+
+def send_report_document(context: CallbackContext, chat_id, cache_key, file_name, data, file_id=None):
+    if file_id:
+        # Already uploaded once, Telegram can resend it by id
+        try:
+            context.bot.send_document(chat_id=chat_id, document=file_id)
+            return
+        except TelegramError as e:
+            logging.warning(f"Failed to resend cached report: {e}")
+    message = context.bot.send_document(chat_id=chat_id, document=BytesIO(data), filename=file_name)
+    if message.document:
+        report_cache.set_file_id(cache_key, message.document.file_id)
+
+
+def report_ready(
+    update: Update, context: CallbackContext, future, progress_message_id, language, cache_key
+):
+    chat_id = update.effective_chat.id
+    try:
+        report = future.result()
+    except Exception as e:
+        logging.error(f"Error generating report: {e}")
+        message_text = languages[language]['error_generating_report']
+        context.bot.edit_message_text(chat_id=chat_id, message_id=progress_message_id, text=message_text)
+        context.user_data['last_bot_message_id'] = progress_message_id
+        return
+
+    # Send the file
+    if report:
+        file_name, data, phases = report
+        for phase, seconds in phases.items():
+            metrics.observe('bot_report_phase_seconds', 'phase', phase, seconds)
+        report_cache.put(cache_key, file_name, data)
+        with metrics.timer('bot_report_phase_seconds', 'phase', 'upload'):
+            send_report_document(context, chat_id, cache_key, file_name, data)
+        # Send notification and delete after 3 seconds
+        message_text = languages[language]['report_sent']
+        context.bot.edit_message_text(chat_id=chat_id, message_id=progress_message_id, text=message_text)
+        context.job_queue.run_once(
+            delete_message, 3, context={'chat_id': chat_id, 'message_id': progress_message_id}
+        )
+        # Return to main menu
+        show_main_menu(update, context, language)
+    else:
+        message_text = languages[language]['no_data']
+        context.bot.edit_message_text(chat_id=chat_id, message_id=progress_message_id, text=message_text)
+        context.user_data['last_bot_message_id'] = progress_message_id
         # Return to main menu
         show_main_menu(update, context, language)
 
-    return ConversationHandler.END
 
+def write_statements(user_id, statements):
+    # Runs the statements in one transaction, directly or through the write-behind
+    # queue. Returns a Future that is done once they are committed.
+    if write_queue is not None:
+        future = write_queue.submit(statements)
+    else:
+        future = Future()
+        with storage.transaction() as conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+        future.set_result(None)
+    future.add_done_callback(lambda f: write_done(user_id, f))
+    return future
 
-def sanitize_comment(comment):
-    # Limit comment length
-    max_length = 200  # Adjust as needed
-    sanitized = comment[:max_length]
-    # Remove any non-printable characters
-    sanitized = ''.join(c for c in sanitized if c.isprintable())
-    return sanitized
 
+def write_done(user_id, future):
+    if future.exception() is not None:
+        logging.error(f"Failed to save entry for user {user_id}: {future.exception()}")
+        return
+    # Cached reports for this user are out of date now
+    report_cache.bump(user_id)
 
-def save_income(user_id, user_data):
-    conn = sqlite3.connect('bot_database.db')
-    c = conn.cursor()
+
+def save_transaction(user_id, kind, amount, currency, comment):
+    # Shared write path for incomes and expenses
     current_time = datetime.now()  # Use datetime.now()
     # Sanitize comment input
-    comment = sanitize_comment(user_data['income_comment'])
-    c.execute(
-        'INSERT INTO incomes (user_id, date, amount, currency, comment) VALUES (?, ?, ?, ?, ?)',
-        (
-            user_id,
-            current_time,
-            user_data['income_amount'],
-            user_data['income_currency'],
-            comment,
-        ),
+    comment = sanitize_comment(comment)
+    amount = to_exact_minor_units(amount, currency)
+    income, expense = (amount, 0) if kind == 'income' else (0, amount)
+    return write_statements(
+        user_id,
+        [
+            (
+                TRANSACTION_INSERT,
+                (user_id, kind, current_time, amount, currency, comment, categories.categorize(comment)),
+            ),
+            (
+                DAILY_TOTALS_UPSERT,
+                (user_id, current_time.date().isoformat(), currency, income, expense),
+            ),
+        ],
+    )
+
+
+def save_income(user_id, user_data):
+    return save_transaction(
+        user_id,
+        'income',
+        user_data['income_amount'],
+        user_data['income_currency'],
+        user_data['income_comment'],
     )
-    conn.commit()
-    conn.close()
 
 
 def save_expense(user_id, user_data):
-    conn = sqlite3.connect('bot_database.db')
-    c = conn.cursor()
-    current_time = datetime.now()  # Use datetime.now()
-    # Sanitize comment input
-    comment = sanitize_comment(user_data['expense_comment'])
-    c.execute(
-        'INSERT INTO expenses (user_id, date, amount, currency, comment) VALUES (?, ?, ?, ?, ?)',
-        (
-            user_id,
-            current_time,
-            user_data['expense_amount'],
-            user_data['expense_currency'],
-            comment,
-        ),
+    return save_transaction(
+        user_id,
+        'expense',
+        user_data['expense_amount'],
+        user_data['expense_currency'],
+        user_data['expense_comment'],
     )
-    conn.commit()
-    conn.close()
 
 
-def create_report(user_id, period, language):
-    conn = sqlite3.connect('bot_database.db')
-    df_income = pd.read_sql_query('SELECT * FROM incomes WHERE user_id = ?', conn, params=(user_id,))
-    df_expense = pd.read_sql_query('SELECT * FROM expenses WHERE user_id = ?', conn, params=(user_id,))
-    conn.close()
+# Users with an import in progress, one at a time each
+imports_running = set()
+imports_lock = threading.Lock()
 
-    if period == 'weekly':
-        date_filter = datetime.now() - pd.Timedelta(days=7)
-        if language == 'uz':
-            file_name = 'Haftalik-hisobot.xlsx'
-        else:
-            file_name = 'Еженедельный-отчет.xlsx'
-    elif period == 'monthly':
-        date_filter = datetime.now() - pd.Timedelta(days=30)
-        if language == 'uz':
-            file_name = 'Oylik-hisobot.xlsx'
-        else:
-            file_name = 'Ежемесячный-отчет.xlsx'
-    else:
-        logging.error("Invalid period specified.")
-        return None
-
-    # Convert 'date' columns to datetime
-    df_income['date'] = pd.to_datetime(df_income['date'])
-    df_expense['date'] = pd.to_datetime(df_expense['date'])
-
-    # Filter data based on date
-    recent_income = df_income[df_income['date'] >= date_filter]
-    recent_expense = df_expense[df_expense['date'] >= date_filter]
-
-    if recent_income.empty and recent_expense.empty:
-        # No data to generate report
-        return None
-
-    # Convert 'amount' column to numeric
-    recent_income['amount'] = pd.to_numeric(recent_income['amount'], errors='coerce')
-    recent_expense['amount'] = pd.to_numeric(recent_expense['amount'], errors='coerce')
-
-    # Drop rows with NaN amounts
-    recent_income = recent_income.dropna(subset=['amount'])
-    recent_expense = recent_expense.dropna(subset=['amount'])
-
-    # Remove 'id' and 'user_id' columns
-    recent_income = recent_income.drop(columns=['id', 'user_id'])
-    recent_expense = recent_expense.drop(columns=['id', 'user_id'])
-
-    # Translate column names
-    if language == 'uz':
-        recent_income.rename(
-            columns={
-                'date': 'Sana',
-                'amount': 'Summa',
-                'currency': 'Valyuta',
-                'comment': 'Kommentariya',
-            },
-            inplace=True,
-        )
-        recent_expense.rename(
-            columns={
-                'date': 'Sana',
-                'amount': 'Summa',
-                'currency': 'Valyuta',
-                'comment': 'Kommentariya',
-            },
-            inplace=True,
-        )
-    else:
-        recent_income.rename(
-            columns={
-                'date': 'Дата',
-                'amount': 'Сумма',
-                'currency': 'Валюта',
-                'comment': 'Комментарий',
-            },
-            inplace=True,
-        )
-        recent_expense.rename(
-            columns={
-                'date': 'Дата',
-                'amount': 'Сумма',
-                'currency': 'Валюта',
-                'comment': 'Комментарий',
-            },
-            inplace=True,
-        )
 
-    # Calculate total amounts by currency
-    if language == 'uz':
-        income_total = recent_income.groupby('Valyuta')['Summa'].sum().reset_index()
-        expense_total = recent_expense.groupby('Valyuta')['Summa'].sum().reset_index()
-    else:
-        income_total = recent_income.groupby('Валюта')['Сумма'].sum().reset_index()
-        expense_total = recent_expense.groupby('Валюта')['Сумма'].sum().reset_index()
-
-    # Create total report dataframe
-    if language == 'uz':
-        total_df = pd.merge(
-            income_total,
-            expense_total,
-            on='Valyuta',
-            how='outer',
-            suffixes=('_Kirim', '_Chiqim'),
-        ).fillna(0)
-        total_df['Balans'] = total_df['Summa_Kirim'] - total_df['Summa_Chiqim']
-        # Rename columns
-        total_df.rename(
-            columns={
-                'Valyuta': 'Valyuta',
-                'Summa_Kirim': 'Umumiy Kirim',
-                'Summa_Chiqim': 'Umumiy Chiqim',
-                'Balans': 'Balans',
-            },
-            inplace=True,
-        )
-    else:
-        total_df = pd.merge(
-            income_total,
-            expense_total,
-            on='Валюта',
-            how='outer',
-            suffixes=('_Доход', '_Расход'),
-        ).fillna(0)
-        total_df['Баланс'] = total_df['Сумма_Доход'] - total_df['Сумма_Расход']
-        # Rename columns
-        total_df.rename(
-            columns={
-                'Валюта': 'Валюта',
-                'Сумма_Доход': 'Общий Доход',
-                'Сумма_Расход': 'Общий Расход',
-                'Баланс': 'Баланс',
-            },
-            inplace=True,
-        )
+def import_document(update: Update, context: CallbackContext):
+    # Bulk import of a CSV/XLSX history: date, type, amount, currency, comment.
+    # Runs async, a large file takes a few seconds.
+    user_id = update.effective_user.id
+    language = get_user_language(user_id) or 'uz'
+    texts = languages[language]
+    chat_id = update.effective_chat.id
+    document = update.message.document
+    file_name = document.file_name or ''
+    if not file_name.lower().endswith(('.csv', '.xlsx')):
+        context.bot.send_message(chat_id=chat_id, text=texts['import_unsupported'])
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        context.bot.send_message(chat_id=chat_id, text=texts['import_too_large'])
+        return
+
+    # One import per user at a time, so a few large files sent together don't
+    # take every run_async thread from reports and exports
+    with imports_lock:
+        busy = user_id in imports_running
+        imports_running.add(user_id)
+    if busy:
+        context.bot.send_message(chat_id=chat_id, text=texts['import_busy'])
+        return
+    try:
+        import_file(context, user_id, texts, chat_id, document, file_name)
+    finally:
+        with imports_lock:
+            imports_running.discard(user_id)
 
-    with pd.ExcelWriter(file_name, engine='openpyxl') as writer:
-        # Write total amounts
-        if not total_df.empty:
-            total_df.to_excel(
-                writer, sheet_name='Umumiy Hisobot' if language == 'uz' else 'Общий Отчет', index=False
-            )
-        # Write detailed data
-        if not recent_income.empty:
-            recent_income.to_excel(
-                writer, sheet_name='Kirimlar' if language == 'uz' else 'Доходы', index=False
-            )
-        if not recent_expense.empty:
-            recent_expense.to_excel(
-                writer, sheet_name='Chiqimlar' if language == 'uz' else 'Расходы', index=False
+
+def import_file(context: CallbackContext, user_id, texts, chat_id, document, file_name):
+    message = context.bot.send_message(chat_id=chat_id, text=texts['import_started'])
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES) as f:
+        try:
+            context.bot.get_file(document.file_id).download(out=f)
+            f.seek(0)
+            result = importer.import_rows(user_id, importer.read_rows(f, file_name))
+        except Exception as e:
+            logging.warning(f"Failed to import {file_name} for user {user_id}: {e}")
+            context.bot.edit_message_text(
+                chat_id=chat_id, message_id=message.message_id, text=texts['import_failed']
             )
+            return
+    if result['imported']:
+        # Cached reports for this user are out of date now
+        report_cache.bump(user_id)
 
-    return file_name
+    lines = [texts['import_done'].format(imported=result['imported'], rejected=result['rejected'])]
+    for line_number, column in result['errors']:
+        lines.append(texts['import_row_error'].format(line=line_number, column=texts['import_columns'][column]))
+    if result['rejected'] > len(result['errors']):
+        lines.append('...')
+    context.bot.edit_message_text(chat_id=chat_id, message_id=message.message_id, text='\n'.join(lines))
+
+
+def rate_command(update: Update, context: CallbackContext):
+    # Admins only: /rate USD 12650.50 [2026-10-01], the date defaults to today
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        return
+    language = get_user_language(user_id) or 'uz'
+    args = context.args
+    try:
+        if len(args) not in (2, 3):
+            raise ValueError('expected currency, rate and an optional date')
+        row = rates.parse_rate(args[0], args[1], args[2] if len(args) == 3 else date.today())
+        rates.save_rates([row])
+    except ValueError as e:
+        logging.warning(f"Invalid /rate from {user_id}: {e}")
+        message_text = languages[language]['invalid_rate']
+    else:
+        # Consolidated balances in cached reports are out of date now
+        report_cache.set_generation(rates.rates_cache.version(max_age=0))
+        currency, day, rate = row
+        message_text = languages[language]['rate_saved'].format(currency=currency, rate=rate, day=day)
+    context.bot.send_message(chat_id=update.effective_chat.id, text=message_text)
+
+
+def format_money(minor, currency):
+    # 150000000, 'UZS' -> '150 000 000'
+    return f'{from_minor_units(minor, currency):,}'.replace(',', ' ')
+
+
+def search_message(language, query, results):
+    # Text and paging keyboard for one page of /search results
+    texts = languages[language]
+    if not results['count']:
+        return texts['search_nothing'].format(query=query), None
+    lines = [texts['search_found'].format(query=query, count=results['count'])]
+    for currency, (income, expense) in results['totals'].items():
+        lines.append(
+            texts['search_totals'].format(
+                currency=currency,
+                income=format_money(income, currency),
+                expense=format_money(expense, currency),
+            )
+        )
+    lines.append('')
+    for ts, kind, amount, currency, comment in results['rows']:
+        arrow = '⬇️' if kind == 'income' else '⬆️'
+        lines.append(f"{ts:%d.%m.%Y} {arrow}{format_money(amount, currency)} {currency} {comment}")
+    if results['pages'] == 1:
+        return '\n'.join(lines), None
+    lines.append(texts['search_page'].format(page=results['page'] + 1, pages=results['pages']))
+    buttons = []
+    if results['page'] > 0:
+        buttons.append(InlineKeyboardButton('⬅️', callback_data=f"search:{results['page'] - 1}"))
+    if results['page'] < results['pages'] - 1:
+        buttons.append(InlineKeyboardButton('➡️', callback_data=f"search:{results['page'] + 1}"))
+    return '\n'.join(lines), InlineKeyboardMarkup([buttons])
+
+
+def search_command(update: Update, context: CallbackContext):
+    # /search taksi aeroport: comments containing every word, newest first
+    user_id = update.effective_user.id
+    language = get_user_language(user_id) or 'uz'
+    chat_id = update.effective_chat.id
+    query = search.normalize(' '.join(context.args))
+    results = search.search(user_id, query)
+    if results is None:
+        context.bot.send_message(chat_id=chat_id, text=languages[language]['search_hint'])
+        return
+    # Kept for the page buttons
+    context.user_data['search_query'] = query
+    message_text, reply_markup = search_message(language, query, results)
+    context.bot.send_message(chat_id=chat_id, text=message_text, reply_markup=reply_markup)
+
+
+def search_page(update: Update, context: CallbackContext):
+    answer_callback_query(update)
+    query = context.user_data.get('search_query')
+    if not query:
+        return
+    user_id = update.effective_user.id
+    language = get_user_language(user_id) or 'uz'
+    page = int(update.callback_query.data.split(':')[1])
+    results = search.search(user_id, query, page)
+    message_text, reply_markup = search_message(language, query, results)
+    context.bot.edit_message_text(
+        chat_id=update.effective_chat.id,
+        message_id=update.callback_query.message.message_id,
+        text=message_text,
+        reply_markup=reply_markup,
+    )
 
 
 def cancel(update: Update, context: CallbackContext):
@@ -828,10 +1147,9 @@ def cancel(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
-def main():
-    init_db()
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
+def add_handlers(dp):
+    # Same handlers whether updates come from polling or the webhook
+    persistent = dp.persistence is not None
 
     # Conversation handler for language selection
     lang_conv_handler = ConversationHandler(
@@ -843,6 +1161,8 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         allow_reentry=True,
+        name='language',
+        persistent=persistent,
     )
 
     dp.add_handler(lang_conv_handler)
@@ -867,6 +1187,8 @@ def main():
             )
         ],
         allow_reentry=True,
+        name='income',
+        persistent=persistent,
     )
 
     expense_conv_handler = ConversationHandler(
@@ -888,6 +1210,8 @@ def main():
             )
         ],
         allow_reentry=True,
+        name='expense',
+        persistent=persistent,
     )
 
     report_conv_handler = ConversationHandler(
@@ -895,10 +1219,14 @@ def main():
             MessageHandler(
                 Filters.regex('^(' + languages['uz']['report'] + '|' + languages['ru']['report'] + ')$'),
                 report_start,
-            )
+            ),
+            CommandHandler('report', report_command),
         ],
         states={
-            REPORT_SELECTION: [CallbackQueryHandler(report_selection, pattern='^(weekly|monthly)$')],
+            REPORT_SELECTION: [
+                CallbackQueryHandler(report_selection, pattern='^(' + '|'.join(reports.PERIODS) + ')$'),
+                CallbackQueryHandler(export_selection, pattern='^export$'),
+            ],
         },
         fallbacks=[
             MessageHandler(
@@ -907,6 +1235,8 @@ def main():
             )
         ],
         allow_reentry=True,
+        name='report',
+        persistent=persistent,
     )
 
     # Add handlers to dispatcher
@@ -926,16 +1256,122 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         allow_reentry=True,
+        name='settings',
+        persistent=persistent,
     )
 
     dp.add_handler(settings_conv_handler)
 
+    dp.add_handler(CommandHandler('rate', rate_command))
+    dp.add_handler(CommandHandler('search', search_command))
+    dp.add_handler(CallbackQueryHandler(search_page, pattern=r'^search:\d+$'))
+    dp.add_handler(MessageHandler(Filters.document, import_document, run_async=True))
+
     # Handler for main menu selections
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, main_menu_selection))
 
+
+def create_updater(global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST):
+    # Every outgoing call goes through the global and per-group rate limits
+    telegram_bot = RateLimitedBot(
+        TOKEN,
+        request=Request(con_pool_size=DISPATCHER_WORKERS + outbound.MAX_WORKERS + outbound.URGENT_WORKERS + 4),
+        limiter=RateLimiter(global_rate, global_burst),
+    )
+    persistence = SQLitePersistence() if PERSIST_STATE else None
+    updater = Updater(
+        bot=telegram_bot, workers=DISPATCHER_WORKERS, use_context=True, persistence=persistence
+    )
+    add_handlers(updater.dispatcher)
+    if metrics.enabled:
+        metrics.instrument_handlers(updater.dispatcher)
+        metrics.register_collector(telegram_bot.limiter.samples)
+    return updater
+
+
+def shutdown(updater):
+    report_pool.shutdown()
+    outbound.shutdown()
+    if write_queue is not None:
+        # Commit whatever is still queued before the connections go away
+        write_queue.close()
+    persistence = updater.dispatcher.persistence
+    if persistence is not None:
+        persistence.close()
+        logging.info(f"Conversation state stats: {persistence.stats()}")
+    logging.info(f"Profile cache stats: {profile_cache.stats()}")
+    logging.info(f"Report cache stats: {report_cache.stats()}")
+    logging.info(f"Rate limiter stats: {updater.bot.limiter.stats()}")
+    storage.close_all()
+
+
+def run_worker(index, shard_queue, workers):
+    # A SHARD_WORKERS process, spawned by the webhook front-end. Stops when
+    # the front-end sends None, so it ignores the signals meant for the front-end.
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_IGN)
+    if METRICS_PORT or SLOW_UPDATE_MS:
+        metrics.enable(slow_threshold=SLOW_UPDATE_MS / 1000)
+    updater = create_updater(GLOBAL_RATE / workers, max(1, GLOBAL_BURST // workers))
+    metrics_server = None
+    if METRICS_PORT:
+        # The front-end has no metrics, worker i serves them on METRICS_PORT + i
+        metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT + index)
+        metrics_server.start()
+    logging.info(f"Shard worker {index} of {workers} started")
+    serve_shard(updater, shard_queue)
+    if metrics_server is not None:
+        metrics_server.stop()
+    shutdown(updater)
+
+
+def main():
+    if METRICS_PORT or SLOW_UPDATE_MS:
+        metrics.enable(slow_threshold=SLOW_UPDATE_MS / 1000)
+    init_db()
+    if RATES_FILE:
+        logging.info(f"Loaded {rates.load_csv(RATES_FILE)} exchange rates from {RATES_FILE}")
+    # Stored categories are redone in the background after a dictionary change,
+    # new entries are already tagged with the current one
+    threading.Thread(target=categories.retag_if_changed, name='retag', daemon=True).start()
+
+    if USE_WEBHOOK and SHARD_WORKERS > 1:
+        # This process only receives and routes updates
+        run_sharded_webhook(
+            RateLimitedBot(TOKEN),
+            run_worker,
+            SHARD_WORKERS,
+            WEBHOOK_LISTEN,
+            WEBHOOK_PORT,
+            WEBHOOK_PATH,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+        storage.close_all()
+        return
+
+    updater = create_updater()
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
+        metrics_server.start()
+
     # Start the bot
-    updater.start_polling()
-    updater.idle()
+    if USE_WEBHOOK:
+        run_webhook(
+            updater,
+            WEBHOOK_LISTEN,
+            WEBHOOK_PORT,
+            WEBHOOK_PATH,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        updater.start_polling()
+        updater.idle()
+    if metrics_server is not None:
+        metrics_server.stop()
+    shutdown(updater)
 
 
 if __name__ == '__main__':
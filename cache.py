@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+
+class ProfileCache:
+    # Bounded LRU cache of user profiles ({'language', 'first_time'}) with a TTL.
+    # Misses are filled by calling loader(user_id).
+
+    def __init__(self, loader, max_size=10000, ttl=600):
+        self._loader = loader
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, profile)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        profile = self._loader(user_id)
+        self.put(user_id, profile)
+        return profile
+
+    def put(self, user_id, profile):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self._ttl, dict(profile))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        # Patch a cached profile after a write; uncached users load on next get()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                profile = dict(entry[1], **fields)
+                self._entries[user_id] = (time.monotonic() + self._ttl, profile)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class ReportCache:
+    # Finished report files keyed by (user_id, period, language, data version,
+    # generation, day). The data version is bumped whenever the user saves a
+    # transaction. The generation is exchange_rates_version, which every report
+    # depends on, passed in by set_generation(). The day and a short TTL keep
+    # rolling 7/30 day windows from going stale.
+
+    def __init__(self, max_bytes=50 * 1024 * 1024, ttl=300):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._entries = OrderedDict()  # key -> entry dict
+        self._versions = {}  # user_id -> data version
+        self._generation = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, user_id, period, language):
+        with self._lock:
+            version = self._versions.get(user_id, 0)
+            generation = self._generation
+        return (user_id, period, language, version, generation, date.today().isoformat())
+
+    def bump(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            for key in [key for key in self._entries if key[0] == user_id]:
+                self._remove(key)
+
+    def set_generation(self, generation):
+        # Drops everything if generation changed
+        with self._lock:
+            if generation == self._generation:
+                return
+            self._generation = generation
+            self._entries.clear()
+            self._size = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry)
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, file_name, data):
+        with self._lock:
+            # Data changed while the report was being built, don't keep it
+            if key[3] != self._versions.get(key[0], 0) or key[4] != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                'expires_at': time.monotonic() + self._ttl,
+                'file_name': file_name,
+                'data': data,
+                'file_id': None,
+            }
+            self._size += len(data)
+            while self._size > self._max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def set_file_id(self, key, file_id):
+        # Telegram file_id of the first upload, lets repeats skip the upload
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['file_id'] = file_id
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry['data'])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
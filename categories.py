@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import re
+
+import migrations
+import storage
+
+# Keywords per category, Uzbek (Latin) and Russian, lower case. A keyword
+# matches at the start of a word and may be followed by a suffix ("taksi"
+# also matches "taksiga", "аптек" matches "аптека"); keywords of up to
+# SHORT_KEYWORD letters only match a whole word. At a given position the
+# longest keyword wins, across the comment the first match wins.
+KEYWORDS = {
+    'transport': [
+        'taksi', 'avtobus', 'metro', 'benzin', "yoqilg'i", 'propan', 'metan', 'parkovka',
+        "yo'l kira", 'poyezd', 'samolyot', 'avia', 'chipta',
+        'такси', 'автобус', 'метро', 'бензин', 'топлив', 'парковк', 'проезд', 'поезд', 'билет',
+    ],
+    'groceries': [
+        'bozor', 'non', "go'sht", 'meva', 'sabzavot', 'oziq', 'supermarket', 'korzinka', 'makro',
+        'havas', 'sut', 'guruch', "yog'",
+        'продукт', 'хлеб', 'мясо', 'рынок', 'базар', 'супермаркет', 'овощ', 'фрукт', 'молок',
+    ],
+    'eating_out': [
+        'kafe', 'restoran', 'choyxona', 'osh', 'tushlik', 'nonushta', 'kechki ovqat', 'obed',
+        'fastfud', 'lavash', 'shashlik', 'kofe',
+        'кафе', 'ресторан', 'обед', 'ужин', 'завтрак', 'кофе', 'столов', 'доставка еды',
+    ],
+    'utilities': [
+        'kommunal', 'svet', 'elektr', 'gaz', 'suv', 'internet', 'telefon', 'mobil', 'uzmobile',
+        'beeline', 'ucell', 'mobiuz',
+        'коммунал', 'свет', 'электр', 'газ', 'вода', 'интернет', 'телефон', 'связь',
+    ],
+    'housing': [
+        'ijara', 'kvartira', 'uy', 'remont', "ta'mir", 'mebel',
+        'аренд', 'квартир', 'ремонт', 'ипотек', 'мебел',
+    ],
+    'health': [
+        'dori', 'dorixona', 'shifokor', 'klinika', 'kasalxona', 'stomatolog', 'tish', 'analiz',
+        'аптек', 'лекарств', 'врач', 'клиник', 'больниц', 'стоматолог', 'анализ',
+    ],
+    'education': [
+        "o'qish", 'kurs', 'kitob', 'maktab', 'universitet', 'kontrakt', 'repetitor', "bog'cha",
+        'учеб', 'курс', 'книг', 'школ', 'университет', 'репетитор', 'садик',
+    ],
+    'clothing': [
+        'kiyim', 'poyabzal', 'krossovka', 'kurtka', "ko'ylak",
+        'одежд', 'обув', 'кроссовк', 'куртк', 'рубашк',
+    ],
+    'leisure': [
+        'kino', 'teatr', 'konsert', "o'yin", 'sayohat', 'dam olish', 'sport', 'zal',
+        'кино', 'театр', 'концерт', 'игра', 'игры', 'путешеств', 'отдых', 'спорт',
+    ],
+    'gifts': [
+        "sovg'a", "to'y", "tug'ilgan kun", 'xayriya',
+        'подар', 'свадьб', 'день рождения', 'благотвор',
+    ],
+    'salary': [
+        'oylik', 'maosh', 'ish haqi', 'avans', 'bonus', 'mukofot',
+        'зарплат', 'аванс', 'премия', 'премии', 'бонус', 'оклад',
+    ],
+    'transfers': [
+        "o'tkazma", 'qarz', 'kredit',
+        'перевод', 'долг', 'кредит', 'займ',
+    ],
+}
+SHORT_KEYWORD = 3
+
+# Rows per transaction of the retag job
+RETAG_BATCH = 5000
+
+# Uzbek o' and g' are typed with any of these
+APOSTROPHES = str.maketrans({c: "'" for c in 'ʻʼ‘’`'})
+SPACES = re.compile(r'\s+')
+
+
+def normalize(text):
+    return SPACES.sub(' ', text.lower().translate(APOSTROPHES))
+
+
+def build_trie(keywords):
+    # {char: node}, a node ending a keyword holds its category under '' and
+    # whether it must end the word under None
+    trie = {}
+    for category, words in keywords.items():
+        for word in words:
+            word = normalize(word).strip()
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = category
+            node[None] = sum(c.isalnum() for c in word) <= SHORT_KEYWORD
+    return trie
+
+
+TRIE = build_trie(KEYWORDS)
+# Changes whenever the dictionaries do, stored rows tagged with another
+# version are redone by retag()
+DICTIONARY_VERSION = hashlib.sha1(repr(sorted(KEYWORDS.items())).encode()).hexdigest()[:12]
+
+
+def is_word_char(char):
+    return char.isalnum() or char == "'"
+
+
+def categorize(comment):
+    # Category of a comment or None, one trie walk from every word start
+    if not comment:
+        return None
+    text = normalize(comment)
+    length = len(text)
+    for start in range(length):
+        if start and is_word_char(text[start - 1]):
+            continue
+        node = TRIE
+        found = None
+        position = start
+        while position < length:
+            node = node.get(text[position])
+            if node is None:
+                break
+            position += 1
+            if '' in node and not (node[None] and position < length and is_word_char(text[position])):
+                found = node['']
+        if found is not None:
+            return found
+    return None
+
+
+def stored_version():
+    row = storage.fetchone('SELECT version FROM category_version WHERE id = 1')
+    return row[0] if row else None
+
+
+def retag(batch_size=RETAG_BATCH):
+    # Recomputes the category of every transaction, in id order, one batch
+    # per transaction so entries saved meanwhile aren't held up. Returns the
+    # number of rows whose category changed.
+    changed = 0
+    last_id = 0
+    while True:
+        rows = storage.fetchall(
+            'SELECT id, comment, category FROM transactions WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, batch_size),
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for row_id, comment, category in rows:
+            new_category = categorize(comment)
+            if new_category != category:
+                updates.append((new_category, row_id))
+        if updates:
+            with storage.transaction() as conn:
+                conn.executemany('UPDATE transactions SET category = ? WHERE id = ?', updates)
+        changed += len(updates)
+    storage.execute('UPDATE category_version SET version = ? WHERE id = 1', (DICTIONARY_VERSION,))
+    return changed
+
+
+def retag_if_changed():
+    # Run at startup, after a KEYWORDS change or the migration that added the column
+    if stored_version() == DICTIONARY_VERSION:
+        return 0
+    changed = retag()
+    logging.info(f"Categories retagged with dictionary {DICTIONARY_VERSION}: {changed} rows changed")
+    return changed
+
+
+if __name__ == '__main__':
+    # python categories.py: retag the history now, whatever the stored version
+    logging.basicConfig(level=logging.INFO)
+    migrations.migrate(storage.get_connection())
+    logging.info(f"Retagged {retag()} transactions")
@@ -0,0 +1,10 @@
+# Comments are cleaned up the same way whether typed in the bot or imported
+MAX_COMMENT_LENGTH = 200
+
+
+def sanitize_comment(comment):
+    # Limit comment length
+    sanitized = comment[:MAX_COMMENT_LENGTH]
+    # Remove any non-printable characters
+    sanitized = ''.join(c for c in sanitized if c.isprintable())
+    return sanitized
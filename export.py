@@ -0,0 +1,67 @@
+import csv
+import gzip
+import io
+from datetime import date
+
+import storage
+from amounts import currency_decimals
+
+# Rows fetched from the cursor and written per chunk, the only rows in memory
+CHUNK_ROWS = 5000
+# gzip level 6 compresses ledger csv nearly as well as 9 in half the time
+COMPRESS_LEVEL = 6
+
+export_texts = {
+    'uz': {
+        'file_name': 'Tarix-{day}.csv.gz',
+        'columns': ['Sana', 'Tur', 'Summa', 'Valyuta', 'Kommentariya'],
+    },
+    'ru': {
+        'file_name': 'История-{day}.csv.gz',
+        'columns': ['Дата', 'Тип', 'Сумма', 'Валюта', 'Комментарий'],
+    },
+}
+
+# The whole history in time order, a range scan on idx_transactions_user_ts.
+# ts stays the stored 'YYYY-MM-DD HH:MM:SS' text, no datetime round trip.
+EXPORT_QUERY = """
+    SELECT ts, kind, amount, currency, comment
+    FROM transactions
+    WHERE user_id = ?
+    ORDER BY ts
+"""
+
+
+def format_amount(minor, currency):
+    # 1234, 'USD' -> '12.34' without going through Decimal for every row
+    decimals = currency_decimals(currency)
+    if not decimals:
+        return str(minor)
+    sign = '-' if minor < 0 else ''
+    units, fraction = divmod(abs(minor), 10 ** decimals)
+    return f'{sign}{units}.{fraction:0{decimals}d}'
+
+
+def export_history(user_id, language, fileobj):
+    # Writes the user's transactions to fileobj as gzip-compressed csv, in the
+    # column layout importer.py reads back. Returns (file_name, rows written).
+    texts = export_texts['uz' if language == 'uz' else 'ru']
+    rows = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=COMPRESS_LEVEL) as archive:
+        # utf-8-sig so Excel shows Cyrillic comments correctly
+        text = io.TextIOWrapper(archive, encoding='utf-8-sig', newline='')
+        writer = csv.writer(text)
+        writer.writerow(texts['columns'])
+        cursor = storage.get_connection().execute(EXPORT_QUERY, (user_id,))
+        while True:
+            chunk = cursor.fetchmany(CHUNK_ROWS)
+            if not chunk:
+                break
+            writer.writerows(
+                (ts[:19], kind, format_amount(amount, currency), currency, comment)
+                for ts, kind, amount, currency, comment in chunk
+            )
+            rows += len(chunk)
+        text.flush()
+        text.detach()
+    return texts['file_name'].format(day=date.today().isoformat()), rows
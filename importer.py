@@ -0,0 +1,323 @@
+import csv
+import io
+import itertools
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from xml.etree import ElementTree
+
+import storage
+from amounts import MAX_AMOUNT, parse_amount, to_exact_minor_units
+from categories import categorize
+from comments import sanitize_comment
+
+# Rows staged per executemany call
+BATCH_SIZE = 5000
+# Rejected rows listed in the summary message, the rest are only counted
+MAX_REPORTED_ERRORS = 20
+CURRENCIES = ('USD', 'UZS')
+# Accepted values of the type column, compared in lower case
+KINDS = {
+    'income': 'income',
+    'kirim': 'income',
+    'доход': 'income',
+    'приход': 'income',
+    'expense': 'expense',
+    'chiqim': 'expense',
+    'расход': 'expense',
+}
+DATE_FORMATS = ('%d.%m.%Y', '%d.%m.%Y %H:%M', '%d.%m.%Y %H:%M:%S')
+
+TRANSACTION_INSERT = '''
+    INSERT INTO transactions (user_id, kind, ts, amount, currency, comment, category)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+# Parsed rows wait here, in the connection's temp database, so the file is
+# read without holding the write lock on the main database
+STAGING_TABLE = '''
+    CREATE TEMP TABLE IF NOT EXISTS import_staging (
+        kind TEXT NOT NULL,
+        ts TIMESTAMP,
+        amount INTEGER NOT NULL,
+        currency TEXT,
+        comment TEXT,
+        category TEXT
+    )
+'''
+STAGING_INSERT = '''
+    INSERT INTO temp.import_staging (kind, ts, amount, currency, comment, category)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+STAGED_TRANSACTIONS_INSERT = '''
+    INSERT INTO transactions (user_id, kind, ts, amount, currency, comment, category)
+    SELECT ?, kind, ts, amount, currency, comment, category FROM temp.import_staging ORDER BY rowid
+'''
+DAILY_TOTALS_UPSERT = '''
+    INSERT INTO daily_totals (user_id, day, currency, income, expense) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, day, currency) DO UPDATE SET
+        income = income + excluded.income,
+        expense = expense + excluded.expense
+'''
+
+
+class InvalidRow(ValueError):
+    # args[0] is the column that failed: columns, date, type, amount or currency
+    pass
+
+
+# SpreadsheetML namespaces, ElementTree spells tags as "{namespace}name"
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+
+def read_rows(fileobj, file_name):
+    # Yields (line number, cells) without loading the whole file
+    if file_name.lower().endswith('.xlsx'):
+        yield from read_xlsx_rows(fileobj)
+        return
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    try:
+        sample = text.read(4096)
+        text.seek(0)
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t') if sample else csv.excel
+    except csv.Error:
+        dialect = csv.excel
+    try:
+        yield from enumerate(csv.reader(text, dialect), start=1)
+    finally:
+        text.detach()
+
+
+def read_xlsx_rows(fileobj):
+    # Streams the first sheet with iterparse, dropping each row once it is
+    # read. openpyxl's read-only mode does the same but builds a cell object
+    # per value, several times slower on 100k-row files. Its number format and
+    # date helpers are reused so dates come out the same, imported here as
+    # openpyxl adds ~100 ms to startup and most uploads are csv.
+    from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+
+    with zipfile.ZipFile(fileobj) as archive:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        properties = workbook.find(f'{MAIN_NS}workbookPr')
+        epoch = CALENDAR_WINDOWS_1900
+        if properties is not None and properties.get('date1904') in ('1', 'true'):
+            epoch = CALENDAR_MAC_1904
+        strings = read_shared_strings(archive)
+        date_styles = read_date_styles(archive)
+
+        c_tag, v_tag, t_tag, row_tag = (MAIN_NS + name for name in ('c', 'v', 't', 'row'))
+        sheet_data = None
+        line_number = 0
+        cells = []
+        with archive.open(first_sheet_path(archive, workbook)) as sheet:
+            for event, element in ElementTree.iterparse(sheet, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == MAIN_NS + 'sheetData':
+                        sheet_data = element
+                    continue
+                tag = element.tag
+                if tag == c_tag:
+                    reference = element.get('r')
+                    column = column_index(reference) if reference else len(cells)
+                    cell_type = element.get('t')
+                    if cell_type == 'inlineStr':
+                        value = ''.join(text.text or '' for text in element.iter(t_tag))
+                    else:
+                        value = element.findtext(v_tag)
+                        if value is None:
+                            pass
+                        elif cell_type == 's':
+                            value = strings[int(value)]
+                        elif cell_type == 'b':
+                            value = value == '1'
+                        elif cell_type not in ('str', 'e'):
+                            value = float(value) if '.' in value or 'E' in value else int(value)
+                            if int(element.get('s') or 0) in date_styles:
+                                value = from_excel(value, epoch)
+                    if column >= len(cells):
+                        cells.extend([None] * (column - len(cells) + 1))
+                    cells[column] = value
+                elif tag == row_tag:
+                    line_number = int(element.get('r') or line_number + 1)
+                    yield line_number, cells
+                    cells = []
+                    # Rows already read are not kept around
+                    sheet_data.clear()
+
+
+def first_sheet_path(archive, workbook):
+    sheet = workbook.find(f'{MAIN_NS}sheets/{MAIN_NS}sheet')
+    relationship_id = sheet.get(f'{RELATIONSHIP_NS}id')
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for relationship in relationships.iter(f'{PACKAGE_NS}Relationship'):
+        if relationship.get('Id') == relationship_id:
+            target = relationship.get('Target')
+            return target[1:] if target.startswith('/') else 'xl/' + target
+    raise KeyError(f'no sheet for relationship {relationship_id}')
+
+
+def read_shared_strings(archive):
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    strings = []
+    si_tag, t_tag, r_tag = (MAIN_NS + name for name in ('si', 't', 'r'))
+    with archive.open('xl/sharedStrings.xml') as f:
+        for event, element in ElementTree.iterparse(f):
+            if element.tag == si_tag:
+                # Plain text or rich text runs, phonetic hints (rPh) are left out
+                text = element.findtext(t_tag)
+                if text is None:
+                    text = ''.join(run.findtext(t_tag) or '' for run in element.iter(r_tag))
+                strings.append(text)
+                element.clear()
+    return strings
+
+
+def read_date_styles(archive):
+    # Indexes of the cell styles whose number format is a date or time
+    from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+
+    if 'xl/styles.xml' not in archive.namelist():
+        return set()
+    styles = ElementTree.fromstring(archive.read('xl/styles.xml'))
+    formats = dict(BUILTIN_FORMATS)
+    for number_format in styles.iter(f'{MAIN_NS}numFmt'):
+        formats[int(number_format.get('numFmtId'))] = number_format.get('formatCode')
+    cell_styles = styles.find(f'{MAIN_NS}cellXfs')
+    if cell_styles is None:
+        return set()
+    return {
+        index
+        for index, style in enumerate(cell_styles.iter(f'{MAIN_NS}xf'))
+        if is_date_format(formats.get(int(style.get('numFmtId') or 0)))
+    }
+
+
+def column_index(reference):
+    # "C12" -> 2
+    index = 0
+    for char in reference:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+def naive_local(ts):
+    # Stored timestamps are naive local time, like datetime.now() in
+    # save_transaction. An offset ("+05:00", "Z") would also break the
+    # sqlite3 timestamp converter on every later read of the user's rows.
+    if ts.tzinfo is None:
+        return ts
+    return ts.astimezone().replace(tzinfo=None)
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return naive_local(value)
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    text = str(value or '').strip()
+    try:
+        return naive_local(datetime.fromisoformat(text))
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    raise InvalidRow('date')
+
+
+def parse_cell_amount(value):
+    # Spreadsheet cells come as numbers, csv cells as text like "1 000,50"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            amount = Decimal(str(value))
+        except InvalidOperation:
+            raise InvalidRow('amount') from None
+        if not amount.is_finite() or amount <= 0 or amount >= MAX_AMOUNT:
+            raise InvalidRow('amount')
+        return amount
+    try:
+        return parse_amount(str(value or ''))
+    except ValueError:
+        raise InvalidRow('amount') from None
+
+
+def parse_row(cells):
+    # Columns: date, type, amount, currency, comment (optional).
+    # Returns (kind, datetime, amount in minor units, currency, comment)
+    cells = list(cells)
+    while cells and cells[-1] in (None, ''):
+        cells.pop()
+    if len(cells) not in (4, 5):
+        raise InvalidRow('columns')
+    ts = parse_date(cells[0])
+    kind = KINDS.get(str(cells[1] or '').strip().lower())
+    if kind is None:
+        raise InvalidRow('type')
+    currency = str(cells[3] or '').strip().upper()
+    if currency not in CURRENCIES:
+        raise InvalidRow('currency')
+    try:
+        amount = to_exact_minor_units(parse_cell_amount(cells[2]), currency)
+    except ValueError:
+        raise InvalidRow('amount') from None
+    comment = sanitize_comment(str(cells[4]) if len(cells) == 5 and cells[4] is not None else '')
+    return kind, ts, amount, currency, comment
+
+
+def import_rows(user_id, rows):
+    # Validates and inserts (line number, cells) rows, all or nothing. The
+    # rows are parsed into the staging table first and then copied in one
+    # short transaction, other users' saves only wait for the copy.
+    # A first line that isn't a valid row is taken for a header.
+    result = {'imported': 0, 'rejected': 0, 'errors': []}
+    totals = {}
+
+    def valid_rows():
+        for line_number, cells in rows:
+            if not any(cell not in (None, '') for cell in cells):
+                continue
+            try:
+                kind, ts, amount, currency, comment = parse_row(cells)
+            except InvalidRow as e:
+                if line_number == 1:
+                    continue
+                result['rejected'] += 1
+                if len(result['errors']) < MAX_REPORTED_ERRORS:
+                    result['errors'].append((line_number, e.args[0]))
+                continue
+            day_totals = totals.setdefault((ts.date().isoformat(), currency), [0, 0])
+            day_totals[0 if kind == 'income' else 1] += amount
+            yield kind, ts, amount, currency, comment, categorize(comment)
+
+    conn = storage.get_connection()
+    conn.execute(STAGING_TABLE)
+    try:
+        batches = valid_rows()
+        with conn:
+            # Only writes the temp database, the main one stays unlocked
+            while True:
+                batch = list(itertools.islice(batches, BATCH_SIZE))
+                if not batch:
+                    break
+                conn.executemany(STAGING_INSERT, batch)
+                result['imported'] += len(batch)
+        if result['imported']:
+            with storage.transaction() as conn:
+                conn.execute(STAGED_TRANSACTIONS_INSERT, (user_id,))
+                conn.executemany(
+                    DAILY_TOTALS_UPSERT,
+                    [
+                        (user_id, day, currency, income, expense)
+                        for (day, currency), (income, expense) in totals.items()
+                    ],
+                )
+    finally:
+        with conn:
+            conn.execute('DELETE FROM temp.import_staging')
+    return result
@@ -0,0 +1,244 @@
+import functools
+import logging
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.ext import ConversationHandler
+
+import storage
+
+# Upper bounds in seconds, from a cached SQL lookup up to a large report upload
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Longest SQL label, statements are identified by their (shortened) text
+MAX_STATEMENT_LABEL = 120
+
+# Set by enable(), the wrappers below only cost anything once it is on
+enabled = False
+# Updates whose handler takes longer than this many seconds are logged, 0 to disable
+slow_update_threshold = 0
+
+_HELP = {
+    'bot_handler_seconds': 'Time spent in each update handler',
+    'bot_sql_seconds': 'Time spent executing each SQL statement',
+    'bot_telegram_api_seconds': 'Duration of Telegram Bot API requests by method',
+    'bot_report_phase_seconds': 'Time spent in each report building phase',
+}
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.total += 1
+            self.sum += value
+
+    def snapshot(self):
+        # Cumulative counts per bucket, as Prometheus expects them
+        with self._lock:
+            cumulative = []
+            running = 0
+            for count in self.counts:
+                running += count
+                cumulative.append(running)
+            return cumulative, self.total, self.sum
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+# Callables returning [(name, type, help, value)], read on every scrape for
+# counters and gauges kept elsewhere (the rate limiter's)
+_collectors = []
+
+
+def histogram(name, label, value):
+    key = (name, label, value)
+    found = _histograms.get(key)
+    if found is None:
+        with _histograms_lock:
+            found = _histograms.setdefault(key, Histogram())
+    return found
+
+
+def observe(name, label, value, seconds):
+    histogram(name, label, value).observe(seconds)
+
+
+@contextmanager
+def timer(name, label, value):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, label, value, time.perf_counter() - start)
+
+
+def register_collector(collect):
+    with _histograms_lock:
+        _collectors.append(collect)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    # Prometheus text exposition format
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+        collectors = list(_collectors)
+    lines = []
+    for collect in collectors:
+        for name, metric_type, help_text, value in collect():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.append(f'{name} {value}')
+    current = None
+    for (name, label, value), hist in items:
+        if name != current:
+            current = name
+            lines.append(f'# HELP {name} {_HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+        counts, total, seconds = hist.snapshot()
+        labels = f'{label}="{_escape(value)}"'
+        for bound, count in zip(hist.buckets, counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {total}')
+        lines.append(f'{name}_sum{{{labels}}} {seconds}')
+        lines.append(f'{name}_count{{{labels}}} {total}')
+    return '\n'.join(lines) + '\n'
+
+
+# SQL timing: storage opens its connections with this class once metrics are enabled.
+# Only execution is timed, rows fetched later from the cursor are not.
+
+_statement_labels = {}
+
+
+def statement_label(sql):
+    label = _statement_labels.get(sql)
+    if label is None:
+        label = re.sub(r'\s+', ' ', sql).strip()[:MAX_STATEMENT_LABEL]
+        _statement_labels[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            observe('bot_sql_seconds', 'statement', statement_label(sql), time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            observe('bot_sql_seconds', 'statement', statement_label(sql), time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+
+def timed_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def wrapper(update, context, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return callback(update, context, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            observe('bot_handler_seconds', 'handler', name, elapsed)
+            if slow_update_threshold and elapsed > slow_update_threshold:
+                update_id = getattr(update, 'update_id', None)
+                logging.warning(f"Slow update {update_id}: {name} took {elapsed * 1000:.0f} ms")
+
+    return wrapper
+
+
+def instrument_handlers(dispatcher):
+    # Times the callbacks of every registered handler, including the ones
+    # nested in ConversationHandlers
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for nested in handler.entry_points + handler.fallbacks:
+                wrap(nested)
+            for state_handlers in handler.states.values():
+                for nested in state_handlers:
+                    wrap(nested)
+        else:
+            handler.callback = timed_handler(handler.callback)
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+
+def enable(slow_threshold=0):
+    # Call before the first database connection is opened
+    global enabled, slow_update_threshold
+    enabled = True
+    slow_update_threshold = slow_threshold
+    storage.CONNECTION_FACTORY = TimedConnection
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != self.server.path:
+            self.send_response(HTTPStatus.NOT_FOUND)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics {self.address_string()}: {format % args}")
+
+
+class MetricsServer(ThreadingHTTPServer):
+    # Serves render() for a Prometheus scraper, keep it on a local address
+    daemon_threads = True
+
+    def __init__(self, listen, port, path='/metrics'):
+        super().__init__((listen, port), MetricsHandler)
+        self.path = path
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
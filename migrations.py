@@ -0,0 +1,313 @@
+import logging
+
+from amounts import MAX_AMOUNT
+
+# Schema migrations, applied once in order at startup. The number of the last
+# applied migration is kept in PRAGMA user_version. Append new migrations at
+# the end, never edit or reorder the ones that have shipped.
+
+
+def create_base_tables(c):
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY,
+                        language TEXT,
+                        first_time BOOLEAN DEFAULT 1
+                    )'''
+    )
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS incomes (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        date TIMESTAMP,
+                        amount REAL,
+                        currency TEXT,
+                        comment TEXT,
+                        FOREIGN KEY(user_id) REFERENCES users(user_id)
+                    )'''
+    )
+    c.execute(
+        '''CREATE TABLE IF NOT EXISTS expenses (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        date TIMESTAMP,
+                        amount REAL,
+                        currency TEXT,
+                        comment TEXT,
+                        FOREIGN KEY(user_id) REFERENCES users(user_id)
+                    )'''
+    )
+
+
+def create_user_date_indexes(c):
+    # Reports read one user's rows within a date range
+    c.execute('CREATE INDEX IF NOT EXISTS idx_incomes_user_date ON incomes (user_id, date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date)')
+
+
+def create_daily_totals(c):
+    # Per-day totals, kept up to date by save_income/save_expense. Databases
+    # from before versioned migrations may already have it filled in.
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'daily_totals'")
+    if c.fetchone() is not None:
+        return
+    c.execute(
+        '''CREATE TABLE daily_totals (
+                        user_id INTEGER,
+                        day TEXT,
+                        currency TEXT,
+                        income REAL DEFAULT 0,
+                        expense REAL DEFAULT 0,
+                        PRIMARY KEY (user_id, day, currency)
+                    ) WITHOUT ROWID'''
+    )
+    c.execute(
+        '''INSERT INTO daily_totals (user_id, day, currency, income, expense)
+           SELECT user_id, date(date), currency, SUM(amount), 0
+           FROM incomes WHERE amount IS NOT NULL
+           GROUP BY user_id, date(date), currency'''
+    )
+    c.execute(
+        '''INSERT INTO daily_totals (user_id, day, currency, income, expense)
+           SELECT user_id, date(date), currency, 0, SUM(amount)
+           FROM expenses WHERE amount IS NOT NULL
+           GROUP BY user_id, date(date), currency
+           ON CONFLICT (user_id, day, currency) DO UPDATE SET expense = expense + excluded.expense'''
+    )
+
+
+def merge_into_transactions(c):
+    # incomes and expenses had identical columns, keep them in one table
+    c.execute(
+        '''CREATE TABLE transactions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        kind TEXT NOT NULL,
+                        ts TIMESTAMP,
+                        amount REAL,
+                        currency TEXT,
+                        comment TEXT,
+                        FOREIGN KEY(user_id) REFERENCES users(user_id)
+                    )'''
+    )
+    c.execute(
+        '''INSERT INTO transactions (user_id, kind, ts, amount, currency, comment)
+           SELECT user_id, kind, date, amount, currency, comment FROM (
+               SELECT user_id, 'income' AS kind, date, amount, currency, comment FROM incomes
+               UNION ALL
+               SELECT user_id, 'expense' AS kind, date, amount, currency, comment FROM expenses
+           )
+           ORDER BY date'''
+    )
+    c.execute('DROP TABLE incomes')
+    c.execute('DROP TABLE expenses')
+    # Covers the per-currency totals of a date range, no table lookups needed
+    c.execute(
+        'CREATE INDEX idx_transactions_user_ts ON transactions (user_id, ts, currency, kind, amount)'
+    )
+
+
+def integer_minor_units(c):
+    # REAL amounts become INTEGER in the currency's smallest unit: cents for
+    # USD, whole sum for UZS. Rows without a usable amount were never reported:
+    # NULL, text that isn't a number, and inf or out of range values that
+    # amounts were parsed with float() could store, which would overflow here.
+    c.execute(
+        '''CREATE TABLE transactions_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        kind TEXT NOT NULL,
+                        ts TIMESTAMP,
+                        amount INTEGER NOT NULL,
+                        currency TEXT,
+                        comment TEXT,
+                        FOREIGN KEY(user_id) REFERENCES users(user_id)
+                    )'''
+    )
+    c.execute(
+        '''INSERT INTO transactions_new (id, user_id, kind, ts, amount, currency, comment)
+           SELECT id, user_id, kind, ts,
+                  CAST(ROUND(CAST(amount AS REAL) * (CASE currency WHEN 'UZS' THEN 1 ELSE 100 END)) AS INTEGER),
+                  currency, comment
+           FROM transactions
+           WHERE typeof(amount) IN ('integer', 'real') AND abs(amount) < ?''',
+        (int(MAX_AMOUNT),),
+    )
+    skipped = c.execute('SELECT COUNT(*) FROM transactions').fetchone()[0] - c.execute(
+        'SELECT COUNT(*) FROM transactions_new'
+    ).fetchone()[0]
+    if skipped:
+        logging.warning(f"Skipped {skipped} transactions without a valid amount")
+    c.execute('DROP TABLE transactions')
+    c.execute('ALTER TABLE transactions_new RENAME TO transactions')
+    c.execute(
+        'CREATE INDEX idx_transactions_user_ts ON transactions (user_id, ts, currency, kind, amount)'
+    )
+    c.execute('DROP TABLE daily_totals')
+    c.execute(
+        '''CREATE TABLE daily_totals (
+                        user_id INTEGER,
+                        day TEXT,
+                        currency TEXT,
+                        income INTEGER NOT NULL DEFAULT 0,
+                        expense INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, day, currency)
+                    ) WITHOUT ROWID'''
+    )
+    c.execute(
+        '''INSERT INTO daily_totals (user_id, day, currency, income, expense)
+           SELECT user_id, date(ts), currency,
+                  SUM(CASE kind WHEN 'income' THEN amount ELSE 0 END),
+                  SUM(CASE kind WHEN 'expense' THEN amount ELSE 0 END)
+           FROM transactions
+           GROUP BY user_id, date(ts), currency'''
+    )
+
+
+def create_conversation_state(c):
+    # Half-finished conversations survive restarts, see persistence.py
+    c.execute(
+        '''CREATE TABLE user_state (
+                        user_id INTEGER PRIMARY KEY,
+                        data BLOB NOT NULL
+                    )'''
+    )
+    c.execute(
+        '''CREATE TABLE conversation_state (
+                        name TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        state INTEGER NOT NULL,
+                        PRIMARY KEY (name, key)
+                    ) WITHOUT ROWID'''
+    )
+    # A user's states are loaded together on their first update
+    c.execute('CREATE INDEX idx_conversation_state_user ON conversation_state (user_id)')
+
+
+def create_exchange_rates(c):
+    # Rates to the base currency by day, see rates.py
+    c.execute(
+        '''CREATE TABLE exchange_rates (
+                        currency TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        rate TEXT NOT NULL,
+                        PRIMARY KEY (currency, day)
+                    ) WITHOUT ROWID'''
+    )
+    # Bumped on every change so cached copies know when to reload
+    c.execute(
+        '''CREATE TABLE exchange_rates_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL
+                    )'''
+    )
+    c.execute('INSERT INTO exchange_rates_version (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(
+            f'''CREATE TRIGGER exchange_rates_{event.lower()} AFTER {event} ON exchange_rates
+               BEGIN
+                   UPDATE exchange_rates_version SET version = version + 1 WHERE id = 1;
+               END'''
+        )
+
+
+def create_transactions_fts(c):
+    # Full-text index of comments for /search, see search.py. Contentless: it
+    # keeps only the index, comments are read from transactions. Each row is
+    # indexed with an "owner" token u<user_id> to match a user's rows only.
+    c.execute(
+        '''CREATE VIRTUAL TABLE transactions_fts USING fts5(
+                        comment, owner, content='', tokenize='unicode61 remove_diacritics 2'
+                    )'''
+    )
+    # A contentless table can only remove a row given the values it was indexed with
+    c.execute(
+        '''CREATE TRIGGER transactions_fts_insert AFTER INSERT ON transactions
+           WHEN new.comment <> ''
+           BEGIN
+               INSERT INTO transactions_fts (rowid, comment, owner)
+               VALUES (new.id, new.comment, 'u' || new.user_id);
+           END'''
+    )
+    c.execute(
+        '''CREATE TRIGGER transactions_fts_delete AFTER DELETE ON transactions
+           WHEN old.comment <> ''
+           BEGIN
+               INSERT INTO transactions_fts (transactions_fts, rowid, comment, owner)
+               VALUES ('delete', old.id, old.comment, 'u' || old.user_id);
+           END'''
+    )
+    c.execute(
+        '''CREATE TRIGGER transactions_fts_update AFTER UPDATE OF comment, user_id ON transactions
+           BEGIN
+               INSERT INTO transactions_fts (transactions_fts, rowid, comment, owner)
+               SELECT 'delete', old.id, old.comment, 'u' || old.user_id WHERE old.comment <> '';
+               INSERT INTO transactions_fts (rowid, comment, owner)
+               SELECT new.id, new.comment, 'u' || new.user_id WHERE new.comment <> '';
+           END'''
+    )
+    c.execute(
+        '''INSERT INTO transactions_fts (rowid, comment, owner)
+           SELECT id, comment, 'u' || user_id FROM transactions
+           WHERE comment <> ''
+        '''
+    )
+    # One segment after the bulk load, later inserts are merged automatically
+    c.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('optimize')")
+
+
+def add_transaction_categories(c):
+    # Category of each entry, set on save from the keyword dictionaries in
+    # categories.py. Existing rows start out NULL, categories.retag_if_changed()
+    # fills them in at startup and again whenever the dictionaries change.
+    c.execute('ALTER TABLE transactions ADD COLUMN category TEXT')
+    # Covering for the per-category report sheet as well
+    c.execute('DROP INDEX idx_transactions_user_ts')
+    c.execute(
+        '''CREATE INDEX idx_transactions_user_ts
+           ON transactions (user_id, ts, currency, kind, amount, category)'''
+    )
+    # Dictionary version the stored categories were computed with
+    c.execute(
+        '''CREATE TABLE category_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version TEXT NOT NULL
+                    )'''
+    )
+    c.execute("INSERT INTO category_version (id, version) VALUES (1, '')")
+
+
+MIGRATIONS = [
+    create_base_tables,
+    create_user_date_indexes,
+    create_daily_totals,
+    merge_into_transactions,
+    integer_minor_units,
+    create_conversation_state,
+    create_exchange_rates,
+    create_transactions_fts,
+    add_transaction_categories,
+]
+
+
+def migrate(conn):
+    # Applies the pending migrations, each in its own transaction, and
+    # returns the resulting schema version
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        c = conn.cursor()
+        c.execute('BEGIN')
+        try:
+            migration(c)
+            c.execute(f'PRAGMA user_version = {number}')
+        except Exception:
+            conn.rollback()
+            logging.error(f"Migration {number} ({migration.__name__}) failed")
+            raise
+        conn.commit()
+        logging.info(f"Applied migration {number}: {migration.__name__}")
+        version = number
+    return version
@@ -0,0 +1,41 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads for Telegram calls nobody waits on (deletes)
+MAX_WORKERS = 8
+# Separate threads for callback answers: low priority deletes can wait up to
+# rate_limit.LOW_PRIORITY_MAX_WAIT for a token, and answers queued behind
+# them would miss Telegram's window for answering the query
+URGENT_WORKERS = 4
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='outbound')
+_urgent_executor = ThreadPoolExecutor(max_workers=URGENT_WORKERS, thread_name_prefix='outbound-urgent')
+
+
+def submit(description, func, *args, **kwargs):
+    # Runs func in the background, failures are logged as "Failed to <description>"
+    return _submit(_executor, description, func, *args, **kwargs)
+
+
+def submit_urgent(description, func, *args, **kwargs):
+    # Same as submit(), for high priority calls that must not queue behind it
+    return _submit(_urgent_executor, description, func, *args, **kwargs)
+
+
+def _submit(executor, description, func, *args, **kwargs):
+    future = executor.submit(func, *args, **kwargs)
+    future.add_done_callback(lambda f: _log_failure(description, f))
+    return future
+
+
+def _log_failure(description, future):
+    if future.cancelled():
+        return
+    e = future.exception()
+    if e is not None:
+        logging.warning(f"Failed to {description}: {e}")
+
+
+def shutdown(wait=True):
+    _urgent_executor.shutdown(wait=wait)
+    _executor.shutdown(wait=wait)
@@ -0,0 +1,302 @@
+import atexit
+import json
+import logging
+import pickle
+import threading
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+import storage
+
+# Seconds between flushes of changed user_data and conversation states
+FLUSH_INTERVAL = 5
+# Users not seen for this many seconds are dropped from memory (after their
+# changes are flushed) and loaded again from the database on their next update
+IDLE_TIMEOUT = 30 * 60
+
+USER_STATE_UPSERT = '''
+    INSERT INTO user_state (user_id, data) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET data = excluded.data
+'''
+CONVERSATION_STATE_UPSERT = '''
+    INSERT INTO conversation_state (name, key, user_id, state) VALUES (?, ?, ?, ?)
+    ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+'''
+
+
+class UserData(defaultdict):
+    # dispatcher.user_data, a user missing from memory is loaded on first access
+
+    def __init__(self, persistence):
+        super().__init__(dict)
+        self._persistence = persistence
+
+    def __missing__(self, user_id):
+        return self._persistence.load_user(user_id)
+
+
+class TrackedDict(dict):
+    # One user's user_data, marks the user touched on every change so that
+    # update_user_data() only pickles users that may have changed. Values are
+    # plain scalars, changes inside them don't need tracking.
+
+    def __init__(self, persistence, user_id, data=()):
+        super().__init__(data)
+        self._persistence = persistence
+        self._user_id = user_id
+
+    def _touch(self):
+        self._persistence.touch(self._user_id)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touch()
+
+    def pop(self, *args):
+        self._touch()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._touch()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._touch()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._touch()
+
+    def clear(self):
+        super().clear()
+        self._touch()
+
+
+class Conversations(dict):
+    # One ConversationHandler's states, keyed by (chat_id, user_id). The
+    # handler only uses get(), `in`, item assignment and del.
+
+    def __init__(self, persistence):
+        super().__init__()
+        self._persistence = persistence
+
+    def get(self, key, default=None):
+        if not super().__contains__(key):
+            self._persistence.load_user(key[-1])
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        if not super().__contains__(key):
+            self._persistence.load_user(key[-1])
+        return super().__contains__(key)
+
+
+class SQLitePersistence(BasePersistence):
+    # user_data and conversation states in bot_database.db. Changes are only
+    # marked dirty on the dispatcher thread and written in batches by a
+    # background thread every FLUSH_INTERVAL seconds. Users are loaded one at
+    # a time when their first update arrives, not all at startup.
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, idle_timeout=IDLE_TIMEOUT):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self._lock = threading.RLock()
+        self._user_data = UserData(self)
+        self._conversations = {}
+        # Users in memory: last update time, conversation keys and the last
+        # saved pickle of their user_data to tell real changes apart
+        self._last_access = {}
+        self._user_keys = {}
+        self._saved = {}
+        # Users whose user_data may have changed since it was last pickled
+        self._touched = set()
+        self._dirty_users = {}
+        self._dirty_conversations = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.loads = 0
+        self.flushed = 0
+        self.evicted = 0
+
+    # Stored values are plain data (ints, strings, Decimals), no Bot instances
+    # to swap out, so skip BasePersistence's deep copies on every update
+    def insert_bot(self, obj):
+        return obj
+
+    def replace_bot(self, obj):
+        return obj
+
+    def load_user(self, user_id):
+        with self._lock:
+            if user_id in self._last_access:
+                self._last_access[user_id] = time.monotonic()
+                return dict.setdefault(self._user_data, user_id, TrackedDict(self, user_id))
+            row = storage.fetchone('SELECT data FROM user_state WHERE user_id = ?', (user_id,))
+            data = TrackedDict(self, user_id, pickle.loads(row[0]) if row else {})
+            keys = set()
+            for name, key, state in storage.fetchall(
+                'SELECT name, key, state FROM conversation_state WHERE user_id = ?', (user_id,)
+            ):
+                if name in self._conversations:
+                    key = tuple(json.loads(key))
+                    dict.__setitem__(self._conversations[name], key, state)
+                    keys.add((name, key))
+            dict.__setitem__(self._user_data, user_id, data)
+            self._user_keys[user_id] = keys
+            self._saved[user_id] = row[0] if row else pickle.dumps({})
+            self._last_access[user_id] = time.monotonic()
+            self.loads += 1
+            return data
+
+    def get_user_data(self):
+        return self._user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        with self._lock:
+            return self._conversations.setdefault(name, Conversations(self))
+
+    def touch(self, user_id):
+        with self._lock:
+            self._touched.add(user_id)
+
+    def refresh_user_data(self, user_id, user_data):
+        # Called before the handlers of each update, the only thing that
+        # counts as activity for evict_idle()
+        with self._lock:
+            self._last_access[user_id] = time.monotonic()
+            self._touched.add(user_id)
+
+    def update_user_data(self, user_id, data):
+        # The JobQueue calls this for every user in memory after each job,
+        # users that weren't touched since their last pickle are skipped
+        with self._lock:
+            if user_id not in self._touched:
+                return
+            self._touched.discard(user_id)
+        pickled = pickle.dumps(dict(data))
+        with self._lock:
+            if pickled != self._saved.get(user_id):
+                self._dirty_users[user_id] = pickled
+        self._start()
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            # A run_async handler is still running, the final state follows
+            return
+        with self._lock:
+            self._dirty_conversations[(name, key)] = new_state
+            self._user_keys.setdefault(key[-1], set()).add((name, key))
+        self._start()
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='persistence', daemon=True
+                    )
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.evict_idle()
+            except Exception as e:
+                logging.error(f"Failed to flush conversation state: {e}")
+
+    def flush(self):
+        with self._lock:
+            users, self._dirty_users = self._dirty_users, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not users and not conversations:
+            return
+        try:
+            with storage.transaction() as conn:
+                conn.executemany(USER_STATE_UPSERT, users.items())
+                conn.executemany(
+                    CONVERSATION_STATE_UPSERT,
+                    [
+                        (name, json.dumps(key), key[-1], state)
+                        for (name, key), state in conversations.items()
+                        if state is not None
+                    ],
+                )
+                conn.executemany(
+                    'DELETE FROM conversation_state WHERE name = ? AND key = ?',
+                    [
+                        (name, json.dumps(key))
+                        for (name, key), state in conversations.items()
+                        if state is None
+                    ],
+                )
+        except Exception:
+            # Put them back unless they changed again in the meantime
+            with self._lock:
+                for user_id, pickled in users.items():
+                    self._dirty_users.setdefault(user_id, pickled)
+                for key, state in conversations.items():
+                    self._dirty_conversations.setdefault(key, state)
+            raise
+        with self._lock:
+            self._saved.update(users)
+        self.flushed += len(users) + len(conversations)
+        logging.debug(f"Flushed state of {len(users)} users, {len(conversations)} conversations")
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            dirty = set(self._dirty_users)
+            dirty.update(key[-1] for _, key in self._dirty_conversations)
+            idle = [
+                user_id
+                for user_id, seen in self._last_access.items()
+                if seen < deadline and user_id not in dirty
+            ]
+            for user_id in idle:
+                dict.pop(self._user_data, user_id, None)
+                for name, key in self._user_keys.pop(user_id, ()):
+                    dict.pop(self._conversations[name], key, None)
+                del self._last_access[user_id]
+                self._saved.pop(user_id, None)
+                self._touched.discard(user_id)
+            self.evicted += len(idle)
+        return len(idle)
+
+    def close(self):
+        # Stops the flush thread and writes what is still pending
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._last_access),
+                'dirty': len(self._dirty_users) + len(self._dirty_conversations),
+                'loads': self.loads,
+                'flushed': self.flushed,
+                'evicted': self.evicted,
+            }
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+import metrics
+
+# Telegram flood limits: ~30 messages/s overall, 20/min in a group. Only
+# groups get a per-chat bucket: waits run on the calling thread, usually the
+# dispatcher's, and a 1/s private chat bucket would hold every other user up
+# behind one fast tapper. Private chats only back off on RetryAfter.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+# Low priority calls give up after waiting this long
+LOW_PRIORITY_MAX_WAIT = 30
+# Attempts per call when Telegram answers with RetryAfter
+MAX_RETRIES = 3
+# Idle per-chat buckets are pruned once there are more than this many
+MAX_CHAT_BUCKETS = 10000
+
+HIGH = 0
+LOW = 1
+
+# method -> (priority, position of chat_id for the per-chat limit or None)
+LIMITED_METHODS = {
+    'send_message': (HIGH, 0),
+    'send_document': (HIGH, 0),
+    'edit_message_text': (HIGH, 1),
+    'answer_callback_query': (HIGH, None),
+    'delete_message': (LOW, None),
+}
+
+
+def is_group(chat_id):
+    # Group and channel ids are negative, private chats are the user's id
+    return isinstance(chat_id, int) and chat_id < 0
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now, needed=1):
+        # Seconds until `needed` tokens are available
+        self._refill(now)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    # Global and per-group token buckets. Low priority calls leave a global token
+    # for every waiting high priority call, and are dropped after LOW_PRIORITY_MAX_WAIT.
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST):
+        # Several processes sharing one bot token each get a part of the global rate
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._cond = threading.Condition()
+        self._high_waiting = 0
+        self._blocked_until = 0
+        self._started = time.monotonic()
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+        self.waited = 0.0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                for idle in [key for key, value in self._chats.items() if value.is_full(now)]:
+                    del self._chats[idle]
+            bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def acquire(self, chat_id, priority):
+        # Blocks until the call may go out, returns False if it was dropped
+        start = time.monotonic()
+        with self._cond:
+            if priority == HIGH:
+                self._high_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if priority == LOW and now - start > LOW_PRIORITY_MAX_WAIT:
+                        self.dropped += 1
+                        return False
+                    needed = 1 if priority == HIGH else 1 + self._high_waiting
+                    chat_bucket = self._chat_bucket(chat_id) if is_group(chat_id) else None
+                    wait = max(
+                        self._global.delay(now, needed),
+                        chat_bucket.delay(now) if chat_bucket else 0,
+                        self._blocked_until - now,
+                    )
+                    if wait <= 0:
+                        self._global.take()
+                        if chat_bucket:
+                            chat_bucket.take()
+                        self.sent += 1
+                        self.waited += now - start
+                        return True
+                    # High priority calls finishing wake low priority ones early
+                    self._cond.wait(wait)
+            finally:
+                if priority == HIGH:
+                    self._high_waiting -= 1
+                    self._cond.notify_all()
+
+    def retry_after(self, seconds):
+        # Telegram asked us to back off, hold every call until then
+        with self._cond:
+            self.retried += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            elapsed = time.monotonic() - self._started
+            return {
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'retried': self.retried,
+                'per_second': self.sent / elapsed if elapsed else 0,
+                'avg_wait': self.waited / self.sent if self.sent else 0,
+                'chats': len(self._chats),
+            }
+
+    def samples(self):
+        # For metrics.register_collector()
+        with self._cond:
+            sent, dropped, retried, waited, chats = (
+                self.sent, self.dropped, self.retried, self.waited, len(self._chats)
+            )
+        return [
+            ('bot_rate_limiter_sent_total', 'counter', 'Telegram calls let through the rate limiter', sent),
+            ('bot_rate_limiter_dropped_total', 'counter', 'Low priority calls dropped after waiting too long', dropped),
+            ('bot_rate_limiter_retry_after_total', 'counter', 'RetryAfter answers from Telegram', retried),
+            ('bot_rate_limiter_wait_seconds_total', 'counter', 'Time calls spent waiting for a token', waited),
+            ('bot_rate_limiter_group_chats', 'gauge', 'Group chats with a rate limit bucket', chats),
+        ]
+
+
+class RateLimitedBot(ExtBot):
+    # Bot whose outgoing messages go through a RateLimiter. Updates are bound
+    # to this bot, so query.answer() and message.reply_text() are limited too.
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter or RateLimiter()
+
+    def _limited(self, name, method, *args, **kwargs):
+        priority, chat_position = LIMITED_METHODS[name]
+        chat_id = None
+        if chat_position is not None:
+            chat_id = kwargs.get('chat_id', args[chat_position] if len(args) > chat_position else None)
+        for attempt in range(MAX_RETRIES):
+            if not self.limiter.acquire(chat_id, priority):
+                logging.warning(f"Dropped {name} to chat {chat_id}, rate limit wait too long")
+                return None
+            try:
+                return method(*args, **kwargs)
+            except RetryAfter as e:
+                logging.warning(f"{name} hit flood control, retrying in {e.retry_after}s")
+                self.limiter.retry_after(e.retry_after)
+                if attempt == MAX_RETRIES - 1:
+                    raise
+
+    def _post(self, endpoint, *args, **kwargs):
+        # getUpdates is a long poll, its duration says nothing about Telegram
+        if not metrics.enabled or endpoint == 'getUpdates':
+            return super()._post(endpoint, *args, **kwargs)
+        with metrics.timer('bot_telegram_api_seconds', 'method', endpoint):
+            return super()._post(endpoint, *args, **kwargs)
+
+    def send_message(self, *args, **kwargs):
+        return self._limited('send_message', super().send_message, *args, **kwargs)
+
+    def send_document(self, *args, **kwargs):
+        return self._limited('send_document', super().send_document, *args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._limited('edit_message_text', super().edit_message_text, *args, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._limited('answer_callback_query', super().answer_callback_query, *args, **kwargs)
+
+    def delete_message(self, *args, **kwargs):
+        return self._limited('delete_message', super().delete_message, *args, **kwargs)
@@ -0,0 +1,140 @@
+import csv
+import logging
+import sys
+import threading
+import time
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+import migrations
+import storage
+from amounts import from_minor_units
+
+# Consolidated figures are in this currency. A rate is the number of
+# BASE_CURRENCY units one unit of the other currency was worth on that day.
+BASE_CURRENCY = 'UZS'
+# Seconds a read of exchange_rates_version is reused by RatesCache.version()
+VERSION_CHECK_INTERVAL = 5
+
+RATE_UPSERT = '''
+    INSERT INTO exchange_rates (currency, day, rate) VALUES (?, ?, ?)
+    ON CONFLICT (currency, day) DO UPDATE SET rate = excluded.rate
+'''
+
+
+def parse_rate(currency, rate, day):
+    # Returns a (currency, 'YYYY-MM-DD', rate) row for RATE_UPSERT, raises ValueError
+    currency = currency.strip().upper()
+    if not currency.isalpha() or len(currency) != 3 or currency == BASE_CURRENCY:
+        raise ValueError(f'invalid currency: {currency!r}')
+    try:
+        value = Decimal(rate.strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f'invalid rate: {rate!r}') from None
+    if not value.is_finite() or value <= 0:
+        raise ValueError(f'invalid rate: {rate!r}')
+    day = date.fromisoformat(day.strip()) if isinstance(day, str) else day
+    return currency, day.isoformat(), str(value)
+
+
+def save_rates(rows):
+    with storage.transaction() as conn:
+        conn.executemany(RATE_UPSERT, rows)
+    return len(rows)
+
+
+def load_csv(path):
+    # Lines of "YYYY-MM-DD,CUR,rate", an optional header line is skipped
+    rows = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for line_number, line in enumerate(csv.reader(f), start=1):
+            if not line or (line_number == 1 and not line[0][:1].isdigit()):
+                continue
+            try:
+                day, currency, rate = line
+                rows.append(parse_rate(currency, rate, day))
+            except ValueError as e:
+                raise ValueError(f'{path}:{line_number}: {e}') from None
+    return save_rates(rows)
+
+
+class RatesCache:
+    # Every rate, {currency: ([day, ...], [Decimal rate, ...])} sorted by day.
+    # The table is reread only when exchange_rates_version changes, which the
+    # triggers on exchange_rates bump for every write, from any process.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._rates = {}
+        self.reloads = 0
+        self._checked_version = None
+        self._checked_at = None
+
+    def get(self):
+        version = storage.fetchone('SELECT version FROM exchange_rates_version')[0]
+        with self._lock:
+            if version == self._version:
+                return self._rates
+        rates = {}
+        for currency, day, rate in storage.fetchall(
+            'SELECT currency, day, rate FROM exchange_rates ORDER BY currency, day'
+        ):
+            days, values = rates.setdefault(currency, ([], []))
+            days.append(day)
+            values.append(Decimal(rate))
+        with self._lock:
+            self._version = version
+            self._rates = rates
+            self.reloads += 1
+        return rates
+
+    def version(self, max_age=VERSION_CHECK_INTERVAL):
+        # exchange_rates_version, read from the database at most every max_age
+        # seconds, so callers on a hot path don't run a query each time
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < max_age:
+                return self._checked_version
+        version = storage.fetchone('SELECT version FROM exchange_rates_version')[0]
+        with self._lock:
+            self._checked_version = version
+            self._checked_at = now
+        return version
+
+
+rates_cache = RatesCache()
+
+
+def consolidate(daily_balances, rates):
+    # daily_balances: (day, currency, balance in minor units) sorted by day.
+    # As-of merge: each day gets the latest rate on or before it (days before
+    # the first known rate get the first one), with one forward-moving
+    # position per currency instead of a search per row. Returns
+    # {currency: balance in BASE_CURRENCY}, None for currencies without rates.
+    totals = {}
+    positions = {}
+    for day, currency, balance in daily_balances:
+        amount = from_minor_units(balance, currency)
+        if currency == BASE_CURRENCY:
+            totals[currency] = totals.get(currency, 0) + amount
+            continue
+        if currency not in rates:
+            totals[currency] = None
+            continue
+        days, values = rates[currency]
+        i = positions.get(currency, 0)
+        while i + 1 < len(days) and days[i + 1] <= day:
+            i += 1
+        positions[currency] = i
+        totals[currency] = totals.get(currency, 0) + amount * values[i]
+    return totals
+
+
+if __name__ == '__main__':
+    # python rates.py rates.csv
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2:
+        sys.exit('usage: python rates.py RATES.csv')
+    migrations.migrate(storage.get_connection())
+    logging.info(f"Loaded {load_csv(sys.argv[1])} exchange rates")
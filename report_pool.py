@@ -0,0 +1,109 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import reports
+import storage
+
+# Report building is CPU bound, keep it off the dispatcher threads
+MAX_WORKERS = max(1, min(2, os.cpu_count() or 1))
+# Reports waiting or running across all users
+MAX_PENDING = 20
+# Reports waiting or running for a single user
+MAX_PER_USER = 1
+
+
+class ReportQueueFull(Exception):
+    pass
+
+
+def init_worker(db_path):
+    # Worker processes are spawned fresh and open their own connections
+    storage.DB_PATH = db_path
+
+
+def build_report(user_id, period, language):
+    # Runs in a worker process, returns (file_name, xlsx bytes, phase timings) or None
+    phases = {}
+    report = reports.create_report(user_id, period, language, phases)
+    if report is None:
+        return None
+    file_name, buffer = report
+    return file_name, buffer.getvalue(), phases
+
+
+class ReportPool:
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING, max_per_user=MAX_PER_USER):
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._max_per_user = max_per_user
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._per_user = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(storage.DB_PATH,),
+            )
+        return self._executor
+
+    def submit(self, user_id, period, language):
+        # Raises ReportQueueFull when the pool or the user is at capacity
+        with self._lock:
+            if self._pending >= self._max_pending:
+                raise ReportQueueFull('report queue is full')
+            if self._per_user.get(user_id, 0) >= self._max_per_user:
+                raise ReportQueueFull(f'user {user_id} already has a report in progress')
+            executor = self._get_executor()
+            self._pending += 1
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            try:
+                future = executor.submit(build_report, user_id, period, language)
+            except BrokenProcessPool:
+                # A worker died (OOM, killed), the executor refuses all work
+                # from then on. Start a new one and try once more.
+                executor = self._replace_executor(executor)
+                future = executor.submit(build_report, user_id, period, language)
+        except Exception:
+            self._release(user_id)
+            raise
+        future.add_done_callback(lambda f: self._release(user_id))
+        return future
+
+    def _replace_executor(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                logging.warning("Report pool is broken, starting new worker processes")
+                self._executor = None
+            executor = self._get_executor()
+        broken.shutdown(wait=False)
+        return executor
+
+    def _release(self, user_id):
+        with self._lock:
+            self._pending -= 1
+            remaining = self._per_user.get(user_id, 0) - 1
+            if remaining > 0:
+                self._per_user[user_id] = remaining
+            else:
+                self._per_user.pop(user_id, None)
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+            logging.info("Report pool shut down")
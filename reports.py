@@ -0,0 +1,324 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import rates
+import storage
+from amounts import from_minor_units, to_minor_units
+
+# Report texts per language
+report_texts = {
+    'uz': {
+        'file_names': {
+            'weekly': 'Haftalik-hisobot.xlsx',
+            'monthly': 'Oylik-hisobot.xlsx',
+            'this_month': 'Joriy-oy-hisobot.xlsx',
+            'last_month': 'Otgan-oy-hisobot.xlsx',
+            'year': 'Yillik-hisobot.xlsx',
+        },
+        'custom_file_name': 'Hisobot-{start}-{end}.xlsx',
+        'summary_sheet': 'Umumiy Hisobot',
+        'income_sheet': 'Kirimlar',
+        'expense_sheet': 'Chiqimlar',
+        'summary_columns': ['Valyuta', 'Umumiy Kirim', 'Umumiy Chiqim', 'Balans', 'Balans ({base})'],
+        'total_row': 'Jami',
+        'detail_columns': ['Sana', 'Summa', 'Valyuta', 'Kommentariya'],
+        'category_sheet': 'Kategoriyalar',
+        'category_columns': ['Kategoriya', 'Valyuta', 'Kirim', 'Chiqim'],
+        'categories': {
+            'transport': 'Transport',
+            'groceries': 'Oziq-ovqat',
+            'eating_out': 'Kafe va restoranlar',
+            'utilities': 'Kommunal va aloqa',
+            'housing': 'Uy-joy',
+            'health': "Sog'liq",
+            'education': "Ta'lim",
+            'clothing': 'Kiyim',
+            'leisure': 'Dam olish',
+            'gifts': "Sovg'alar",
+            'salary': 'Maosh',
+            'transfers': "O'tkazmalar va qarzlar",
+            None: 'Boshqa',
+        },
+    },
+    'ru': {
+        'file_names': {
+            'weekly': 'Еженедельный-отчет.xlsx',
+            'monthly': 'Ежемесячный-отчет.xlsx',
+            'this_month': 'Отчет-за-текущий-месяц.xlsx',
+            'last_month': 'Отчет-за-прошлый-месяц.xlsx',
+            'year': 'Отчет-с-начала-года.xlsx',
+        },
+        'custom_file_name': 'Отчет-{start}-{end}.xlsx',
+        'summary_sheet': 'Общий Отчет',
+        'income_sheet': 'Доходы',
+        'expense_sheet': 'Расходы',
+        'summary_columns': ['Валюта', 'Общий Доход', 'Общий Расход', 'Баланс', 'Баланс ({base})'],
+        'total_row': 'Итого',
+        'detail_columns': ['Дата', 'Сумма', 'Валюта', 'Комментарий'],
+        'category_sheet': 'Категории',
+        'category_columns': ['Категория', 'Валюта', 'Доход', 'Расход'],
+        'categories': {
+            'transport': 'Транспорт',
+            'groceries': 'Продукты',
+            'eating_out': 'Кафе и рестораны',
+            'utilities': 'Коммунальные и связь',
+            'housing': 'Жилье',
+            'health': 'Здоровье',
+            'education': 'Образование',
+            'clothing': 'Одежда',
+            'leisure': 'Отдых',
+            'gifts': 'Подарки',
+            'salary': 'Зарплата',
+            'transfers': 'Переводы и долги',
+            None: 'Прочее',
+        },
+    },
+}
+
+# Rolling periods, counted back from now
+PERIOD_DAYS = {
+    'weekly': 7,
+    'monthly': 30,
+}
+# Calendar periods: the current month, the previous month and the year to date
+CALENDAR_PERIODS = ('this_month', 'last_month', 'year')
+PERIODS = tuple(PERIOD_DAYS) + CALENDAR_PERIODS
+
+# Rows per detail sheet, xlsx sheets end at 1,048,576 rows including the header
+SHEET_ROWS = 1048575
+
+# Only the rows inside the report period are read, as a range scan on
+# idx_transactions_user_ts. "ts [timestamp]" is converted to datetime via PARSE_COLNAMES
+DETAIL_QUERY = """
+    SELECT ts AS "ts [timestamp]", amount, currency, comment
+    FROM transactions
+    WHERE user_id = ? AND ts >= ? AND ts < ? AND kind = ?
+    ORDER BY ts
+"""
+
+# Whole days come from the daily_totals rollup, at most one row per day and currency
+ROLLUP_TOTALS_QUERY = """
+    SELECT currency, SUM(income), SUM(expense)
+    FROM daily_totals
+    WHERE user_id = ? AND day >= ? AND day < ?
+    GROUP BY currency
+"""
+
+# The first, partial day of a rolling period is summed from the raw rows,
+# answered from idx_transactions_user_ts alone
+RANGE_TOTALS_QUERY = """
+    SELECT currency, kind, SUM(amount)
+    FROM transactions
+    WHERE user_id = ? AND ts >= ? AND ts < ?
+    GROUP BY currency, kind
+"""
+
+# Per-category totals (see categories.py), answered from idx_transactions_user_ts
+# alone. The rollup has no categories, so whole days are read from the raw rows too.
+CATEGORY_TOTALS_QUERY = """
+    SELECT category, currency, kind, SUM(amount)
+    FROM transactions
+    WHERE user_id = ? AND ts >= ? AND ts < ?
+    GROUP BY category, currency, kind
+"""
+
+# Per-day balances for the consolidated column, in day order straight from
+# the daily_totals primary key
+DAILY_BALANCES_QUERY = """
+    SELECT day, currency, income - expense
+    FROM daily_totals
+    WHERE user_id = ? AND day >= ? AND day < ?
+    ORDER BY day
+"""
+
+
+def midnight(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def period_range(period, now=None):
+    # [start, end) of a report period, end is always a midnight. A custom
+    # period is a (first_day, last_day) tuple of dates, both included.
+    now = now or datetime.now()
+    tomorrow = midnight(now.date() + timedelta(days=1))
+    if isinstance(period, tuple):
+        first_day, last_day = period
+        return midnight(first_day), midnight(last_day + timedelta(days=1))
+    if period in PERIOD_DAYS:
+        return now - timedelta(days=PERIOD_DAYS[period]), tomorrow
+    month_start = midnight(now.date().replace(day=1))
+    if period == 'this_month':
+        return month_start, midnight((month_start + timedelta(days=31)).date().replace(day=1))
+    if period == 'last_month':
+        return (month_start - timedelta(days=1)).replace(day=1), month_start
+    if period == 'year':
+        return month_start.replace(month=1), tomorrow
+    raise ValueError(f'unknown report period: {period!r}')
+
+
+def whole_days_from(start):
+    # First day of a period that is covered in full and can be read from daily_totals
+    day = start.date()
+    return day if start == midnight(day) else day + timedelta(days=1)
+
+
+def get_totals(user_id, start, end):
+    # Per-currency [income, expense, balance] for [start, end), exact integers
+    # in minor units (see amounts.py)
+    conn = storage.get_connection()
+    first_full_day = whole_days_from(start)
+    totals = {}
+    for currency, income, expense in conn.execute(
+        ROLLUP_TOTALS_QUERY, (user_id, first_full_day.isoformat(), end.date().isoformat())
+    ):
+        totals[currency] = [income, expense]
+    if first_full_day != start.date():
+        for currency, kind, amount in conn.execute(
+            RANGE_TOTALS_QUERY, (user_id, start, min(end, midnight(first_full_day)))
+        ):
+            totals.setdefault(currency, [0, 0])[0 if kind == 'income' else 1] += amount
+    return {
+        currency: [income, expense, income - expense]
+        for currency, (income, expense) in sorted(totals.items(), key=lambda item: str(item[0]))
+    }
+
+
+def get_daily_balances(user_id, start, end):
+    # (day, currency, balance in minor units) for [start, end), in day order
+    conn = storage.get_connection()
+    first_full_day = whole_days_from(start)
+    if first_full_day != start.date():
+        partial = {}
+        for currency, kind, amount in conn.execute(
+            RANGE_TOTALS_QUERY, (user_id, start, min(end, midnight(first_full_day)))
+        ):
+            partial[currency] = partial.get(currency, 0) + (amount if kind == 'income' else -amount)
+        for currency, balance in partial.items():
+            yield start.date().isoformat(), currency, balance
+    yield from conn.execute(
+        DAILY_BALANCES_QUERY, (user_id, first_full_day.isoformat(), end.date().isoformat())
+    )
+
+
+def get_category_totals(user_id, start, end):
+    # {(category, currency): [income, expense]} in minor units for [start, end),
+    # category None for uncategorized entries
+    totals = {}
+    for category, currency, kind, amount in storage.get_connection().execute(
+        CATEGORY_TOTALS_QUERY, (user_id, start, end)
+    ):
+        totals.setdefault((category, currency), [0, 0])[0 if kind == 'income' else 1] += amount
+    return totals
+
+
+def write_category_sheet(workbook, texts, category_totals):
+    # Categories in the order of texts['categories'], "other" last, then by currency
+    order = {category: number for number, category in enumerate(texts['categories'])}
+    sheet = workbook.create_sheet(texts['category_sheet'])
+    sheet.append(texts['category_columns'])
+    for (category, currency), (income, expense) in sorted(
+        category_totals.items(),
+        key=lambda item: (order.get(item[0][0], len(order)), str(item[0][1])),
+    ):
+        sheet.append([
+            texts['categories'].get(category, category),
+            currency,
+            from_minor_units(income, currency),
+            from_minor_units(expense, currency),
+        ])
+
+
+def get_consolidated(user_id, start, end):
+    # Each currency's balance in rates.BASE_CURRENCY at the rate of the day
+    # of each transaction, None where no rate is known
+    consolidated = rates.consolidate(get_daily_balances(user_id, start, end), rates.rates_cache.get())
+    return {
+        currency: None if value is None else from_minor_units(
+            to_minor_units(value, rates.BASE_CURRENCY), rates.BASE_CURRENCY
+        )
+        for currency, value in consolidated.items()
+    }
+
+
+def write_detail_sheet(workbook, title, columns, kind, user_id, start, end):
+    conn = storage.get_connection()
+    cursor = conn.execute(DETAIL_QUERY, (user_id, start, end, kind))
+    # Stream straight from the cursor, write-only sheets keep nothing in memory.
+    # Multi-year histories that don't fit one sheet continue on "Title (2)" etc.
+    sheet = None
+    for number, row in enumerate(cursor):
+        if number % SHEET_ROWS == 0:
+            part = number // SHEET_ROWS + 1
+            sheet = workbook.create_sheet(title if part == 1 else f'{title} ({part})')
+            sheet.append(columns)
+        sheet.append(detail_row(row))
+
+
+def report_file_name(texts, period):
+    if isinstance(period, tuple):
+        first_day, last_day = period
+        return texts['custom_file_name'].format(start=first_day.isoformat(), end=last_day.isoformat())
+    return texts['file_names'][period]
+
+
+def detail_row(row):
+    ts, amount, currency, comment = row
+    return ts, from_minor_units(amount, currency), currency, comment
+
+
+def create_report(user_id, period, language, phases=None):
+    # Returns (file_name, BytesIO with the workbook) or None if there is no data.
+    # Seconds spent in each phase are stored in `phases` if given: the totals
+    # and consolidated balances ("aggregate"), the detail rows streamed from
+    # SQLite into the sheets ("query") and writing the xlsx file ("serialize").
+    try:
+        start, end = period_range(period)
+    except ValueError as e:
+        logging.error(f"Invalid period specified: {e}")
+        return None
+    if phases is None:
+        phases = {}
+    texts = report_texts['uz' if language == 'uz' else 'ru']
+
+    started = time.perf_counter()
+    totals = get_totals(user_id, start, end)
+    if not totals:
+        # No data to generate report
+        return None
+    consolidated = get_consolidated(user_id, start, end)
+    category_totals = get_category_totals(user_id, start, end)
+    phases['aggregate'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    # Imported on the first report, the bot process itself never needs openpyxl
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    summary = workbook.create_sheet(texts['summary_sheet'])
+    summary.append([column.format(base=rates.BASE_CURRENCY) for column in texts['summary_columns']])
+    for currency, values in totals.items():
+        summary.append(
+            [currency]
+            + [from_minor_units(value, currency) for value in values]
+            + [consolidated.get(currency)]
+        )
+    if all(value is not None for value in consolidated.values()):
+        # Net worth over all currencies
+        summary.append([texts['total_row'], None, None, None, sum(consolidated.values())])
+    write_category_sheet(workbook, texts, category_totals)
+    write_detail_sheet(
+        workbook, texts['income_sheet'], texts['detail_columns'], 'income', user_id, start, end
+    )
+    write_detail_sheet(
+        workbook, texts['expense_sheet'], texts['detail_columns'], 'expense', user_id, start, end
+    )
+    phases['query'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    buffer = BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    phases['serialize'] = time.perf_counter() - started
+    return report_file_name(texts, period), buffer
@@ -0,0 +1,70 @@
+import re
+
+import storage
+
+# Matches shown per page of /search results
+PAGE_SIZE = 10
+# Words of a query beyond this are ignored
+MAX_TERMS = 8
+
+# transactions_fts (migration 8) indexes each comment together with an
+# "owner" token u<user_id>, so the user filter is part of the full-text match
+# instead of a join that would read every user's matches. Results come newest
+# entry first, in rowid order straight from the index.
+TOTALS_QUERY = """
+    SELECT t.currency, t.kind, SUM(t.amount), COUNT(*)
+    FROM transactions_fts JOIN transactions t ON t.id = transactions_fts.rowid
+    WHERE transactions_fts MATCH ?
+    GROUP BY t.currency, t.kind
+"""
+PAGE_QUERY = """
+    SELECT t.ts AS "ts [timestamp]", t.kind, t.amount, t.currency, t.comment
+    FROM transactions_fts JOIN transactions t ON t.id = transactions_fts.rowid
+    WHERE transactions_fts MATCH ?
+    ORDER BY transactions_fts.rowid DESC
+    LIMIT ? OFFSET ?
+"""
+
+
+def match_query(user_id, text):
+    # 'taksi  aeroport' -> 'owner:u42 AND comment:("taksi"* AND "aeroport"*)'.
+    # Every word is quoted, so FTS5 syntax in user input is plain text, and
+    # matched as a prefix: "taksi" finds "taksiga" too. None if nothing to search.
+    terms = []
+    for word in text.split()[:MAX_TERMS]:
+        word = word.replace('"', '')
+        if any(c.isalnum() for c in word):
+            terms.append(f'"{word}"*')
+    if not terms:
+        return None
+    return f'owner:u{int(user_id)} AND comment:({" AND ".join(terms)})'
+
+
+def search(user_id, text, page=0):
+    # Returns None for an empty query, else {'count', 'pages', 'page',
+    # 'totals': {currency: [income, expense]} in minor units, 'rows': the
+    # page's (ts, kind, amount, currency, comment)}
+    query = match_query(user_id, text)
+    if query is None:
+        return None
+    conn = storage.get_connection()
+    totals = {}
+    count = 0
+    for currency, kind, amount, matches in conn.execute(TOTALS_QUERY, (query,)):
+        totals.setdefault(currency, [0, 0])[0 if kind == 'income' else 1] += amount
+        count += matches
+    pages = max(1, -(-count // PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = conn.execute(PAGE_QUERY, (query, PAGE_SIZE, page * PAGE_SIZE)).fetchall() if count else []
+    return {
+        'count': count,
+        'pages': pages,
+        'page': page,
+        'totals': dict(sorted(totals.items(), key=lambda item: str(item[0]))),
+        'rows': rows,
+    }
+
+
+def normalize(text):
+    # The query as shown back to the user
+    return re.sub(r'\s+', ' ', text).strip()
@@ -0,0 +1,94 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = 'bot_database.db'
+
+# Number of compiled statements each connection keeps around for reuse
+STATEMENT_CACHE_SIZE = 256
+# Seconds to wait on a locked database before giving up
+BUSY_TIMEOUT = 10
+# Connection class, metrics.enable() swaps in one that times every statement
+CONNECTION_FACTORY = sqlite3.Connection
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+# Bumped by close_all() so threads drop connections that were closed under them
+_generation = 0
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        # Lets queries ask for typed columns, e.g. 'date AS "date [timestamp]"'
+        detect_types=sqlite3.PARSE_COLNAMES,
+        # Each connection is only used by the thread that opened it,
+        # this just lets close_all() run from the main thread on shutdown
+        check_same_thread=False,
+        factory=CONNECTION_FACTORY,
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def get_connection():
+    # One long-lived connection per thread (dispatcher, workers, job queue)
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'generation', None) != _generation:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+        logging.debug(f"Opened database connection for {threading.current_thread().name}")
+    return conn
+
+
+def fetchone(sql, params=()):
+    return get_connection().execute(sql, params).fetchone()
+
+
+def fetchall(sql, params=()):
+    return get_connection().execute(sql, params).fetchall()
+
+
+def execute(sql, params=()):
+    conn = get_connection()
+    with conn:
+        return conn.execute(sql, params)
+
+
+@contextmanager
+def transaction():
+    # Commits on success, rolls back if the block raises
+    conn = get_connection()
+    with conn:
+        yield conn
+
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        with _connections_lock:
+            if conn in _connections:
+                _connections.remove(conn)
+        conn.close()
+
+
+def close_all():
+    global _generation
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to close database connection: {e}")
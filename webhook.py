@@ -0,0 +1,257 @@
+import hmac
+import json
+import logging
+import multiprocessing
+import queue
+import secrets
+import signal
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+# Updates waiting for the dispatcher before new ones are turned away with 503,
+# Telegram redelivers them later
+MAX_QUEUE = 1000
+# Largest request body accepted, updates are a few KB at most
+MAX_BODY = 1024 * 1024
+# Seconds to let the dispatcher work through queued updates on shutdown
+DRAIN_TIMEOUT = 10
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Keep-alive, Telegram reuses up to max_connections connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            self._respond(HTTPStatus.NOT_FOUND)
+            return
+        # Without it anyone reaching the port could post updates as any user
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, server.secret_token):
+            self._respond(HTTPStatus.FORBIDDEN)
+            return
+        if server.is_full():
+            # Backpressure: Telegram retries failed deliveries
+            server.rejected += 1
+            self._respond(HTTPStatus.SERVICE_UNAVAILABLE, retry_after=1)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_BODY:
+            self._respond(HTTPStatus.BAD_REQUEST)
+            return
+        try:
+            accepted = server.enqueue(self.rfile.read(length))
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning(f"Invalid webhook payload: {e}")
+            self._respond(HTTPStatus.BAD_REQUEST)
+            return
+        if not accepted:
+            server.rejected += 1
+            self._respond(HTTPStatus.SERVICE_UNAVAILABLE, retry_after=1)
+            return
+        server.received += 1
+        self._respond(HTTPStatus.OK)
+
+    def _respond(self, status, retry_after=None):
+        if status != HTTPStatus.OK:
+            # The body may not have been read, don't reuse the connection
+            self.close_connection = True
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(f"Webhook {self.address_string()}: {format % args}")
+
+
+class WebhookServer(ThreadingHTTPServer):
+    # Feeds POSTed updates into the dispatcher's update queue
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, dispatcher, listen, port, path, secret_token, max_queue=MAX_QUEUE):
+        if not secret_token:
+            raise ValueError('a webhook secret token is required')
+        super().__init__((listen, port), WebhookHandler)
+        self.bot = dispatcher.bot
+        self.update_queue = dispatcher.update_queue
+        self.path = path
+        self.secret_token = secret_token
+        self.max_queue = max_queue
+        self.received = 0
+        self.rejected = 0
+
+    def is_full(self):
+        return self.update_queue.qsize() >= self.max_queue
+
+    def enqueue(self, body):
+        # Returns False if the update can't be taken now
+        self.update_queue.put(Update.de_json(json.loads(body), self.bot))
+        return True
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'queued': self.update_queue.qsize(),
+        }
+
+
+def update_user_id(data):
+    # effective_user.id of a raw update (the chat id for channel posts), read
+    # straight from the json so the front-end never builds Update objects
+    if not isinstance(data, dict):
+        raise TypeError('update is not an object')
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+    return 0
+
+
+class ShardedWebhookServer(WebhookServer):
+    # Front-end for several worker processes. Each update goes, still as raw
+    # json, to the worker that owns its user (user_id % workers), so a user's
+    # updates are handled in order by one dispatcher, next to that user's
+    # conversation state and caches.
+
+    def __init__(self, queues, listen, port, path, secret_token):
+        if not secret_token:
+            raise ValueError('a webhook secret token is required')
+        ThreadingHTTPServer.__init__(self, (listen, port), WebhookHandler)
+        self.queues = queues
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self.routed = [0] * len(queues)
+
+    def is_full(self):
+        # Checked per worker in enqueue()
+        return False
+
+    def enqueue(self, body):
+        shard = update_user_id(json.loads(body)) % len(self.queues)
+        try:
+            self.queues[shard].put_nowait(body)
+        except queue.Full:
+            return False
+        self.routed[shard] += 1
+        return True
+
+    def stats(self):
+        return {'received': self.received, 'rejected': self.rejected, 'routed': self.routed}
+
+
+def webhook_secret(url, secret_token):
+    # The configured secret, or a random one when this process registers the
+    # webhook itself. A webhook registered elsewhere must come with its secret.
+    if secret_token:
+        return secret_token
+    if not url:
+        raise ValueError('WEBHOOK_SECRET is required when WEBHOOK_URL is empty')
+    return secrets.token_urlsafe(32)
+
+
+def start_dispatcher(updater):
+    thread = threading.Thread(target=updater.dispatcher.start, name='dispatcher')
+    thread.start()
+    updater.job_queue.start()
+    return thread
+
+
+def stop_dispatcher(updater, thread):
+    # Let already accepted updates run before stopping
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while updater.dispatcher.update_queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    thread.join()
+
+
+def serve_shard(updater, shard_queue):
+    # Worker side of ShardedWebhookServer: feeds updates from the front-end
+    # into the dispatcher until None arrives, then drains and stops
+    dispatcher_thread = start_dispatcher(updater)
+    update_queue = updater.dispatcher.update_queue
+    try:
+        while True:
+            body = shard_queue.get()
+            if body is None:
+                break
+            # Let the bounded shard queue fill up, and the front-end answer
+            # 503, instead of piling updates up in memory here
+            while update_queue.qsize() >= MAX_QUEUE:
+                time.sleep(0.01)
+            try:
+                update_queue.put(Update.de_json(json.loads(body), updater.bot))
+            except (ValueError, TypeError, KeyError) as e:
+                logging.warning(f"Invalid update from the front-end: {e}")
+    finally:
+        stop_dispatcher(updater, dispatcher_thread)
+
+
+def run_sharded_webhook(bot, worker, workers, listen, port, path, url=None, secret_token=None):
+    # Front-end process: starts `workers` processes running worker(index,
+    # shard_queue, workers) and routes updates to them. Blocks until
+    # SIGINT/SIGTERM, then lets every worker drain its queue.
+    secret_token = webhook_secret(url, secret_token)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(MAX_QUEUE) for _ in range(workers)]
+    processes = [
+        context.Process(target=worker, args=(index, queues[index], workers), name=f'shard-{index}')
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    server = ShardedWebhookServer(queues, listen, port, path, secret_token)
+    if url:
+        bot.set_webhook(url=url + path, secret_token=secret_token)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, stop)
+    logging.info(f"Webhook front-end listening on {listen}:{port}{path}, {workers} workers")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for shard_queue in queues:
+            shard_queue.put(None)
+        for process in processes:
+            process.join()
+        logging.info(f"Webhook front-end stopped: {server.stats()}")
+
+
+def run_webhook(updater, listen, port, path, url=None, secret_token=None):
+    # Blocks until SIGINT/SIGTERM, like start_polling() + idle()
+    secret_token = webhook_secret(url, secret_token)
+    server = WebhookServer(updater.dispatcher, listen, port, path, secret_token)
+    dispatcher_thread = start_dispatcher(updater)
+    if url:
+        updater.bot.set_webhook(url=url + path, secret_token=secret_token)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run on this thread
+        threading.Thread(target=server.shutdown).start()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, stop)
+    logging.info(f"Webhook server listening on {listen}:{port}{path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        stop_dispatcher(updater, dispatcher_thread)
+        logging.info(f"Webhook server stopped: {server.stats()}")
@@ -0,0 +1,113 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import storage
+
+# Most writes committed in one transaction
+MAX_BATCH = 200
+# Seconds the writer waits for more writes before committing a batch
+MAX_LINGER = 0.05
+
+_STOP = object()
+
+
+class WriteQueueClosed(Exception):
+    pass
+
+
+class WriteBehindQueue:
+    # Single writer thread that commits queued writes in grouped transactions.
+    # submit() takes a list of (sql, params) that belong to one transaction and
+    # returns a Future that resolves once they are committed.
+
+    def __init__(self, max_batch=MAX_BATCH, max_linger=MAX_LINGER):
+        self._max_batch = max_batch
+        self._max_linger = max_linger
+        self._queue = queue.Queue()
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.committed = 0
+
+    def submit(self, statements):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise WriteQueueClosed('write queue is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            self._queue.put((statements, future))
+        return future
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._max_linger
+            while len(batch) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+        storage.close_connection()
+
+    def _commit(self, batch):
+        # Same statements across the batch go through one executemany
+        grouped = {}
+        for statements, future in batch:
+            for sql, params in statements:
+                grouped.setdefault(sql, []).append(params)
+        try:
+            with storage.transaction() as conn:
+                for sql, params in grouped.items():
+                    conn.executemany(sql, params)
+        except Exception as e:
+            logging.error(f"Batched write of {len(batch)} entries failed, retrying one by one: {e}")
+            for statements, future in batch:
+                self._commit_one(statements, future)
+            return
+        self.batches += 1
+        self.committed += len(batch)
+        for statements, future in batch:
+            future.set_result(None)
+
+    def _commit_one(self, statements, future):
+        try:
+            with storage.transaction() as conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.committed += 1
+        future.set_result(None)
+
+    def close(self, timeout=None):
+        # Commits everything already submitted, then stops the writer
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+            logging.info(f"Write queue flushed: {self.committed} entries in {self.batches} batches")